@@ -1,10 +1,14 @@
 from fastapi import APIRouter
 
-from app.api import contacts, campaigns, mails, webhooks
+from app.api import contacts, campaigns, mails, segments, suppressions, webhooks
 
 
 api_router = APIRouter()
 api_router.include_router(contacts.router, prefix="/contacts", tags=["contacts"])
 api_router.include_router(campaigns.router, prefix="/campaigns", tags=["campaigns"])
 api_router.include_router(mails.router, prefix="/mails", tags=["mails"])
+api_router.include_router(segments.router, prefix="/segments", tags=["segments"])
+api_router.include_router(
+    suppressions.router, prefix="/suppressions", tags=["suppressions"]
+)
 api_router.include_router(webhooks.router, prefix="/webhooks", tags=["webhooks"])
@@ -1,43 +1,77 @@
-from celery import group
-from fastapi import APIRouter, Depends, Query, HTTPException
-from typing import List
-from loguru import logger
+from celery.utils import uuid
+from fastapi import APIRouter, Depends, HTTPException, Response
+from typing import List, Optional
 
 from app.models import (
     Campaign,
     CampaignRead,
     CampaignCreate,
-    CampaignReadWithContacts,
+    CampaignReadWithChanges,
+    CampaignStatsRead,
     CampaignUpdate,
+    Contact,
+    ContactRead,
+    Segment,
+    SegmentDefinition,
 )
-from app.db import Session, get_session
-from app.crud import CRUDCampaign
-from app.worker import send_email_task
+from app.api.pagination import PageParams
+from app.db import AsyncSession, Session, get_async_session, get_session
+from app.crud import CRUDCampaign, CRUDContact, CRUDSegment
+from app.mails import check_template
+from app.progress import get_progress, init_progress
+from app.senders import sender_pool
+from app.worker import start_campaign_task
 
 
 router = APIRouter()
 
 
 crud_campaign = CRUDCampaign(model=Campaign)
+crud_contact = CRUDContact(model=Contact)
+crud_segment = CRUDSegment(model=Segment)
+
+
+def validate_template(html_template: Optional[str], subject: Optional[str]):
+    error = check_template(html_template, subject)
+    if error:
+        raise HTTPException(status_code=422, detail=f"Invalid template : {error}")
 
 
 @router.get("", response_model=List[CampaignRead])
-def get_all_campaigns(
-    offset: int = 0,
-    limit: int = Query(default=20, lte=100),
-    session: Session = Depends(get_session),
+async def get_all_campaigns(
+    response: Response,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    return crud_campaign.get_multi(session=session, offset=offset, limit=limit)
+    items = await crud_campaign.get_multi_async(session=session, **page.dict())
+    page.set_next_cursor(response, items)
+    return items
 
 
-@router.post("", response_model=CampaignReadWithContacts)
+@router.post("", response_model=CampaignReadWithChanges)
 def create_campaign(campaign: CampaignCreate, session: Session = Depends(get_session)):
+    validate_template(campaign.html_template, campaign.subject)
     return crud_campaign.create(session=session, obj=campaign)
 
 
-@router.get("/{campaign_id}", response_model=CampaignReadWithContacts)
+@router.get("/{campaign_id}", response_model=CampaignRead)
 def get_campaign(campaign_id: int, session: Session = Depends(get_session)):
-    return crud_campaign.get(session=session, id=campaign_id)
+    return crud_campaign.get_read(session=session, id=campaign_id)
+
+
+@router.get("/{campaign_id}/contacts", response_model=List[ContactRead])
+async def get_campaign_contacts(
+    campaign_id: int,
+    response: Response,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_async_session),
+):
+    await crud_campaign.get_async(session=session, id=campaign_id)
+    items = await crud_contact.get_multi_async(
+        session=session, campaign_id=campaign_id, **page.dict()
+    )
+    page.set_next_cursor(response, items)
+    return items
 
 
 @router.delete("/{campaign_id}")
@@ -46,60 +80,66 @@ def delete_campaign(campaign_id: int, session: Session = Depends(get_session)):
     return {"ok": True}
 
 
-@router.put("/{campaign_id}", response_model=CampaignReadWithContacts)
+@router.put("/{campaign_id}", response_model=CampaignReadWithChanges)
 def update_campaign(
     campaign_id: int, campaign: CampaignUpdate, session: Session = Depends(get_session)
 ):
+    if campaign.html_template is not None or campaign.subject is not None:
+        validate_template(campaign.html_template, campaign.subject)
     return crud_campaign.update(session=session, id=campaign_id, obj=campaign)
 
 
+@router.post("/{campaign_id}/segments/{segment_id}")
+def add_segment_to_campaign(
+    campaign_id: int, segment_id: int, session: Session = Depends(get_session)
+):
+    segment = crud_segment.get(session=session, id=segment_id)
+    contacts_added = crud_campaign.add_segment(
+        session=session,
+        id=campaign_id,
+        definition=SegmentDefinition.parse_obj(segment.definition),
+    )
+    return {"contacts_added": contacts_added}
+
+
 @router.post("/{campaign_id}/start")
 def start_campaign(campaign_id: int, session: Session = Depends(get_session)):
     campaign = crud_campaign.get(session=session, id=campaign_id)
     if campaign.started:
         raise HTTPException(status_code=409, detail="Campaign already started")
 
-    html_template = """
-    <html>
-        <body>
-            <div style="font-size: 14px;">
-                <p>
-                    Bonjour bonjour,<br><br>
-                    Merci d’avoir rejoint Tinymail.<br><br>
-                    L’équipe Tinymail.
-                </p>
-            </div>
-        </body>
-    </html>
-    """
-
-    logger.debug(f"Campaign contacts : {campaign.contacts}")
-
-    tasks = []
-    for contact in campaign.contacts:
-        logger.info(f"Sending mail to {contact.email}")
-        tasks.append(
-            send_email_task.s(
-                campaign_id=campaign.id,
-                email_to=contact.email,
-                name_from=campaign.sender_name,
-                html_template=html_template,
-                subject=campaign.subject,
-                infos_to_render=contact.meta,
-                unsubscribe_link=True,
-                pixel_link=True,
-            )
-        )
-
-    group(tasks)()
     campaign.started = True
     session.add(campaign)
     session.commit()
 
-    return {"ok": True}
+    # the producer may start before we return, so the progress hash is
+    # initialised with a known task id before enqueuing it
+    job_id = uuid()
+    init_progress(campaign.id, job_id=job_id)
+    start_campaign_task.apply_async(kwargs={"campaign_id": campaign.id}, task_id=job_id)
 
+    return {"ok": True, "job_id": job_id}
 
-@router.get("/{campaign_id}/stats")
-def get_campaign_stats(campaign_id: int, session: Session = Depends(get_session)):
+
+# a plain def, run in the threadpool: the progress is read from redis with
+# the blocking client
+@router.get("/{campaign_id}/progress")
+def get_campaign_progress(campaign_id: int, session: Session = Depends(get_session)):
     campaign = crud_campaign.get(session=session, id=campaign_id)
-    return {"open_rate": campaign.open_rate(), "send_rate": campaign.send_rate()}
+    progress = get_progress(campaign.id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Campaign not started")
+    # what each sender account sent for the campaign, and can still send today
+    sent_by_account = progress.pop("sent_by_account")
+    progress["accounts"] = [
+        {**capacity, "sent": sent_by_account.get(capacity["address"], 0)}
+        for capacity in sender_pool.capacity()
+    ]
+    return progress
+
+
+@router.get("/{campaign_id}/stats", response_model=CampaignStatsRead)
+async def get_campaign_stats(
+    campaign_id: int, session: AsyncSession = Depends(get_async_session)
+):
+    return await crud_campaign.get_stats_async(session=session, id=campaign_id)
@@ -1,17 +1,24 @@
-from fastapi import APIRouter, Depends, Query
-from loguru import logger
-from typing import List
-from email_validator import validate_email, EmailNotValidError
+import csv
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from typing import AsyncIterator, List, Optional
+from sqlmodel import select
 
 from app.models import (
     Contact,
+    ContactCampaignLink,
     ContactRead,
     ContactCreate,
     ContactReadWithCampaigns,
     ContactUpdate,
 )
-from app.db import Session, get_session
+from app.api.pagination import PageParams
+from app.db import AsyncSession, Session, get_async_session, get_session
+from app.contact_cache import invalidate_contacts
 from app.crud import CRUDContact
+from app.export import ExportFormat, export_response
+from app.validation import email_validator
+from settings import settings
 
 
 router = APIRouter()
@@ -20,35 +27,182 @@ router = APIRouter()
 crud_contact = CRUDContact(Contact)
 
 
+def validate_contacts(
+    contacts: List[ContactCreate], check_deliverability: Optional[bool] = None
+):
+    """Validates the emails (their domains in parallel) and drops the
+    duplicates of the batch, the last occurrence of an address winning."""
+    emails = email_validator.validate_many(
+        [c.email for c in contacts], check_deliverability=check_deliverability
+    )
+
+    accepted = {}
+    rejected = []
+    for c, email in zip(contacts, emails):
+        if email is None:
+            rejected.append(c.email)
+            continue
+        c.email = email
+        accepted[email] = c
+
+    return list(accepted.values()), rejected
+
+
+def import_chunk(
+    session: Session,
+    contacts: List[ContactCreate],
+    rejected: List[str],
+    update_existing: bool,
+    check_deliverability: Optional[bool] = None,
+) -> dict:
+    accepted, invalid = validate_contacts(contacts, check_deliverability)
+    rejected = rejected + invalid
+    written = crud_contact.upsert_multi(
+        session=session, objs=accepted, update_existing=update_existing
+    )
+    if update_existing and written:
+        # the updated rows are not known, drop every cached contact
+        invalidate_contacts()
+    return {
+        "accepted": written,
+        "skipped": len(contacts) - len(invalid) - written,
+        "rejected": len(rejected),
+        "rejected_emails": rejected,
+    }
+
+
+async def read_lines(request: Request) -> AsyncIterator[str]:
+    buffer = b""
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8").rstrip("\r")
+
+
+def parse_csv_line(header: List[str], line: str) -> ContactCreate:
+    row = dict(zip(header, next(csv.reader([line]))))
+    status = row.pop("status", None)
+    contact = ContactCreate(email=row.pop("email", ""), meta=row)
+    if status:
+        contact.status = status
+    return contact
+
+
 @router.get("", response_model=List[ContactRead])
-def get_all_contacts(
-    offset: int = 0,
-    limit: int = Query(default=20, lte=100),
-    session: Session = Depends(get_session),
+async def get_all_contacts(
+    response: Response,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    return crud_contact.get_multi(session=session, offset=offset, limit=limit)
+    items = await crud_contact.get_multi_async(session=session, **page.dict())
+    page.set_next_cursor(response, items)
+    return items
+
+
+@router.get("/export")
+def export_contacts(
+    format: ExportFormat = ExportFormat.ndjson,
+    campaign_id: Optional[int] = None,
+    status: Optional[str] = None,
+):
+    columns = [Contact.id, Contact.email, Contact.status, Contact.meta]
+    statement = select(*columns).order_by(Contact.id)
+    if campaign_id:
+        statement = statement.join(
+            ContactCampaignLink, ContactCampaignLink.contact_id == Contact.id
+        ).where(ContactCampaignLink.campaign_id == campaign_id)
+    if status:
+        statement = statement.where(Contact.status == status)
+
+    return export_response(
+        statement, [c.key for c in columns], format=format, name="contacts"
+    )
 
 
 @router.post("")
 def create_contacts(
-    contacts: List[ContactCreate], session: Session = Depends(get_session)
+    contacts: List[ContactCreate],
+    check_deliverability: Optional[bool] = None,
+    session: Session = Depends(get_session),
 ):
-    accepted = []
-    rejected = []
-    for c in contacts:
-        try:
-            email = validate_email(c.email).email
-            c.email = email
-            accepted.append(c)
-        except EmailNotValidError as e:
-            # email is not valid, exception message is human-readable
-            logger.info(str(e))
-            rejected.append(c.email)
-
-    contacts = crud_contact.create_multi(session=session, objs=accepted)
+    accepted, rejected = validate_contacts(contacts, check_deliverability)
+    crud_contact.upsert_multi(session=session, objs=accepted)
     return {"rejected_emails": rejected}
 
 
+@router.post("/import")
+async def import_contacts(
+    request: Request,
+    update_existing: bool = False,
+    check_deliverability: Optional[bool] = None,
+    session: Session = Depends(get_session),
+):
+    """Streams a JSON lines (one contact per line) or CSV (`text/csv`, with an
+    `email` column, the other columns being stored as meta) body, importing
+    it by chunks of CONTACT_IMPORT_CHUNK_SIZE contacts.
+
+    `check_deliverability` overrides EMAIL_CHECK_DELIVERABILITY: false only
+    checks the syntax of the emails, true also checks their domain in DNS."""
+    is_csv = request.headers.get("content-type", "").startswith("text/csv")
+    chunk_size = settings.CONTACT_IMPORT_CHUNK_SIZE
+
+    header = None
+    chunks = []
+    contacts, rejected = [], []
+    async for line in read_lines(request):
+        if not line.strip():
+            continue
+
+        if is_csv and header is None:
+            header = next(csv.reader([line]))
+            if "email" not in header:
+                raise HTTPException(status_code=422, detail="Missing email column")
+            continue
+
+        try:
+            if is_csv:
+                contacts.append(parse_csv_line(header, line))
+            else:
+                contacts.append(ContactCreate.parse_raw(line))
+        except ValueError:
+            rejected.append(line)
+
+        if len(contacts) + len(rejected) >= chunk_size:
+            chunks.append(
+                await run_in_threadpool(
+                    import_chunk,
+                    session,
+                    contacts,
+                    rejected,
+                    update_existing,
+                    check_deliverability,
+                )
+            )
+            contacts, rejected = [], []
+
+    if contacts or rejected:
+        chunks.append(
+            await run_in_threadpool(
+                import_chunk,
+                session,
+                contacts,
+                rejected,
+                update_existing,
+                check_deliverability,
+            )
+        )
+
+    return {
+        "accepted": sum(c["accepted"] for c in chunks),
+        "skipped": sum(c["skipped"] for c in chunks),
+        "rejected": sum(c["rejected"] for c in chunks),
+        "chunks": chunks,
+    }
+
+
 @router.get("/{contact_id}", response_model=ContactReadWithCampaigns)
 def get_contact(contact_id: int, session: Session = Depends(get_session)):
     return crud_contact.get(session=session, id=contact_id)
@@ -57,6 +211,7 @@ def get_contact(contact_id: int, session: Session = Depends(get_session)):
 @router.delete("/{contact_id}")
 def delete_contact(contact_id: int, session: Session = Depends(get_session)):
     crud_contact.delete(session=session, id=contact_id)
+    invalidate_contacts([contact_id])
     return {"ok": True}
 
 
@@ -64,4 +219,6 @@ def delete_contact(contact_id: int, session: Session = Depends(get_session)):
 def update_contact(
     contact_id: int, contact: ContactUpdate, session: Session = Depends(get_session)
 ):
-    return crud_contact.update(session=session, id=contact_id, obj=contact)
+    db_contact = crud_contact.update(session=session, id=contact_id, obj=contact)
+    invalidate_contacts([contact_id])
+    return db_contact
@@ -1,4 +1,8 @@
-from fastapi import APIRouter, Depends, Query
+import time
+from celery.utils import uuid
+from datetime import datetime, timezone
+from fastapi import APIRouter, Depends, Response
+from sqlmodel import select
 from typing import List, Optional
 
 from app.models import (
@@ -6,66 +10,152 @@ from app.models import (
     MailRead,
     MailCreate,
     MailReadWithContact,
+    MailSchedule,
+    MailStatus,
     Contact,
 )
+from app.contact_cache import contact_record
 from app.crud import CRUDMail, CRUDContact
-from app.db import Session, get_session
+from app.api.pagination import PageParams
+from app.export import ExportFormat, export_response
+from app.latency import get_latencies
+from app.db import AsyncSession, Session, get_async_session, get_session
 from app.worker import send_email_task
 
 
 router = APIRouter()
 
+WELCOME_TEMPLATE = """
+<html>
+    <body>
+        <div style="font-size: 14px;">
+            <p>
+                Bonjour bonjour,<br><br>
+                Message de bienvenue de Tinymail.<br><br>
+                L’équipe Tinymail.
+            </p>
+        </div>
+    </body>
+</html>
+"""
+
 
 crud_mail = CRUDMail(Mail)
 crud_contact = CRUDContact(Contact)
 
 
 @router.get("", response_model=List[MailRead])
-def get_all_mails(
-    offset: int = 0,
-    limit: int = Query(default=20, lte=100),
-    session: Session = Depends(get_session),
+async def get_all_mails(
+    response: Response,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_async_session),
     contact_id: Optional[int] = None,
     campaign_id: Optional[int] = None,
 ):
-    return crud_mail.get_multi(
+    items = await crud_mail.get_multi_async(
         session=session,
-        offset=offset,
-        limit=limit,
         contact_id=contact_id,
         campaign_id=campaign_id,
+        **page.dict(),
+    )
+    page.set_next_cursor(response, items)
+    return items
+
+
+@router.get("/export")
+def export_mails(
+    format: ExportFormat = ExportFormat.ndjson,
+    campaign_id: Optional[int] = None,
+    contact_id: Optional[int] = None,
+    is_open: Optional[bool] = None,
+    status: Optional[MailStatus] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    columns = [
+        Mail.id,
+        Mail.contact_id,
+        Mail.campaign_id,
+        Mail.status,
+        Mail.time_send,
+        Mail.is_open,
+    ]
+    statement = select(*columns).order_by(Mail.id)
+    if campaign_id:
+        statement = statement.where(Mail.campaign_id == campaign_id)
+    if contact_id:
+        statement = statement.where(Mail.contact_id == contact_id)
+    if is_open is not None:
+        statement = statement.where(Mail.is_open == is_open)
+    if status:
+        statement = statement.where(Mail.status == status)
+    if since:
+        statement = statement.where(Mail.time_send >= since)
+    if until:
+        statement = statement.where(Mail.time_send < until)
+
+    return export_response(
+        statement, [c.key for c in columns], format=format, name="mails"
     )
 
 
+@router.get("/latency")
+def get_mail_latency():
+    """p50/p99 of the time from enqueuing to the SMTP reply, in seconds, over
+    the last mails sent of each class (transactional or bulk)."""
+    return get_latencies()
+
+
 @router.post("")
 def create_mail(mail: MailCreate, session: Session = Depends(get_session)):
-    # crud_mail.create(session=session, obj=mail)
     contact = crud_contact.get(session=session, id=mail.contact_id)
 
-    html_template = """
-    <html>
-        <body>
-            <div style="font-size: 14px;">
-                <p>
-                    Bonjour bonjour,<br><br>
-                    Message de bienvenue de Tinymail.<br><br>
-                    L’équipe Tinymail.
-                </p>
-            </div>
-        </body>
-    </html>
-    """
-
-    send_email_task.s(
-        email_to=contact.email,
-        name_from=mail.sender_name,
-        html_template=html_template,
-        subject=mail.subject,
-        infos_to_render=contact.meta,
-        unsubscribe_link=True,
-        pixel_link=True,
-    ).apply_async(eta=mail.time_to_send)
+    scheduled_at = mail.time_to_send
+    if scheduled_at and scheduled_at.tzinfo is None:
+        scheduled_at = scheduled_at.replace(tzinfo=timezone.utc)
+    if scheduled_at and scheduled_at <= datetime.now(timezone.utc):
+        scheduled_at = None
+
+    # scheduled mails are stored and enqueued when due by the dispatcher
+    db_mail, created = crud_mail.create_once(
+        session=session,
+        mail={
+            "contact_id": contact.id,
+            "campaign_id": mail.campaign_id,
+            "scheduled_at": scheduled_at,
+            "subject": mail.subject,
+            "sender_name": mail.sender_name,
+            "html_template": mail.html_template or WELCOME_TEMPLATE,
+            "idempotency_key": mail.idempotency_key or uuid(),
+        },
+    )
+
+    # enqueued again on a retried POST if it was lost before being claimed,
+    # the claim keeping it from being sent twice
+    if db_mail.status == MailStatus.queued and not db_mail.scheduled_at:
+        send_email_task.delay(
+            mail_id=db_mail.id,
+            unsubscribe_link=True,
+            pixel_link=True,
+            contact=contact_record(contact),
+            enqueued_at=time.time(),
+        )
+
+    return {"ok": True, "mail_id": db_mail.id, "created": created}
+
+
+@router.put("/{mail_id}/schedule", response_model=MailRead)
+def reschedule_mail(
+    mail_id: int, schedule: MailSchedule, session: Session = Depends(get_session)
+):
+    return crud_mail.reschedule(
+        session=session, id=mail_id, scheduled_at=schedule.scheduled_at
+    )
+
 
+@router.delete("/{mail_id}/schedule")
+def cancel_mail(mail_id: int, session: Session = Depends(get_session)):
+    crud_mail.cancel(session=session, id=mail_id)
     return {"ok": True}
 
 
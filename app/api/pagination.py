@@ -0,0 +1,41 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from fastapi import HTTPException, Query, Response
+from typing import List, Optional
+
+from settings import settings
+
+
+def encode_cursor(last_id: int) -> str:
+    return urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (BinasciiError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class PageParams(object):
+    """Keyset pagination over primary keys: pass back the `X-Next-Cursor`
+    response header as `cursor` (or the last id seen as `after_id`) to get the
+    next page, until the header is missing."""
+
+    def __init__(
+        self,
+        after_id: Optional[int] = None,
+        cursor: Optional[str] = None,
+        offset: int = Query(default=0, deprecated=True),
+        limit: int = Query(default=20, gt=0, le=settings.MAX_PAGE_SIZE),
+    ):
+        self.after_id = decode_cursor(cursor) if cursor else after_id
+        self.offset = offset
+        self.limit = limit
+
+    def dict(self) -> dict:
+        return {"after_id": self.after_id, "offset": self.offset, "limit": self.limit}
+
+    def set_next_cursor(self, response: Response, items: List):
+        if len(items) == self.limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(items[-1].id)
@@ -0,0 +1,54 @@
+from fastapi import APIRouter, Depends, Response
+from typing import List
+
+from app.models import Segment, SegmentCreate, SegmentDefinition, SegmentRead
+from app.api.pagination import PageParams
+from app.db import AsyncSession, Session, get_async_session, get_session
+from app.crud import CRUDSegment
+
+
+router = APIRouter()
+
+
+crud_segment = CRUDSegment(Segment)
+
+
+@router.get("", response_model=List[SegmentRead])
+async def get_all_segments(
+    response: Response,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_async_session),
+):
+    items = await crud_segment.get_multi_async(session=session, **page.dict())
+    page.set_next_cursor(response, items)
+    return items
+
+
+@router.post("", response_model=SegmentRead)
+def create_segment(segment: SegmentCreate, session: Session = Depends(get_session)):
+    return crud_segment.create(session=session, obj=segment)
+
+
+@router.post("/preview")
+def preview_segment(
+    definition: SegmentDefinition, session: Session = Depends(get_session)
+):
+    return {"count": crud_segment.count(session=session, definition=definition)}
+
+
+@router.get("/{segment_id}", response_model=SegmentRead)
+def get_segment(segment_id: int, session: Session = Depends(get_session)):
+    return crud_segment.get(session=session, id=segment_id)
+
+
+@router.get("/{segment_id}/preview")
+def preview_saved_segment(segment_id: int, session: Session = Depends(get_session)):
+    segment = crud_segment.get(session=session, id=segment_id)
+    definition = SegmentDefinition.parse_obj(segment.definition)
+    return {"count": crud_segment.count(session=session, definition=definition)}
+
+
+@router.delete("/{segment_id}")
+def delete_segment(segment_id: int, session: Session = Depends(get_session)):
+    crud_segment.delete(session=session, id=segment_id)
+    return {"ok": True}
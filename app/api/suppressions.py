@@ -0,0 +1,50 @@
+from fastapi import APIRouter, Depends, Response
+from typing import List
+
+from app.models import (
+    Suppression,
+    SuppressionImport,
+    SuppressionReason,
+    SuppressionRead,
+)
+from app.api.pagination import PageParams
+from app.contact_cache import invalidate_contacts
+from app.db import AsyncSession, Session, get_async_session, get_session
+from app.crud import CRUDSuppression
+
+
+router = APIRouter()
+
+
+crud_suppression = CRUDSuppression(Suppression)
+
+
+@router.get("", response_model=List[SuppressionRead])
+async def get_all_suppressions(
+    response: Response,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_async_session),
+):
+    items = await crud_suppression.get_multi_async(session=session, **page.dict())
+    page.set_next_cursor(response, items)
+    return items
+
+
+@router.post("")
+def import_suppressions(
+    suppressions: SuppressionImport, session: Session = Depends(get_session)
+):
+    """Adds a list of emails (unsubscribes, bounces...) to the suppression
+    list: no mail is sent to them anymore."""
+    added = crud_suppression.create_multi(
+        session=session, emails=suppressions.emails, reason=suppressions.reason
+    )
+    if suppressions.reason == SuppressionReason.unsubscribed:
+        invalidate_contacts()
+    return {"added": added}
+
+
+@router.delete("/{suppression_id}")
+def delete_suppression(suppression_id: int, session: Session = Depends(get_session)):
+    crud_suppression.delete(session=session, id=suppression_id)
+    return {"ok": True}
@@ -1,12 +1,13 @@
 from fastapi import APIRouter, Depends
-from fastapi.responses import StreamingResponse, HTMLResponse
-from io import BytesIO
+from fastapi.responses import HTMLResponse, Response
 from loguru import logger
-from PIL import Image
 
+from app.contact_cache import invalidate_contacts
 from app.crud import CRUDMail, CRUDContact
-from app.db import get_session, Session
-from app.models import Mail, Contact
+from app.db import AsyncSession, get_async_session
+from app.models import CampaignStats, Mail, Contact, SuppressionReason
+from app.events import record_open
+from app.suppression import mirror_suppress, suppress
 from app.utils import confirm_token
 
 
@@ -16,32 +17,45 @@ router = APIRouter()
 crud_mail = CRUDMail(Mail)
 crud_contact = CRUDContact(Contact)
 
+# 1x1 transparent GIF
+PIXEL = (
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01"
+    b"\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+)
+# every mail has its own pixel url, and only its first open matters
+PIXEL_HEADERS = {"Cache-Control": "private, max-age=31536000, immutable"}
+
 
 @router.get("/pixel/{token}")
-async def pixel_tracking(token: str, session: Session = Depends(get_session)):
+def pixel_tracking(token: str):
     mail_id = confirm_token(token)
     logger.info(f"Receive pixel tracking request from : {mail_id}")
-    mail = crud_mail.get(session=session, id=mail_id)
-    mail.is_open = True
-    session.add(mail)
-    session.commit()
-
-    pixel = Image.new("RGB", size=(1, 1))
-    pixel_bytes = BytesIO()
-    pixel.save(pixel_bytes, "PNG")
-    pixel_bytes.seek(0)
+    # opens are written to the database by batches, see flush_opens_task
+    if mail_id:
+        record_open(mail_id)
 
-    return StreamingResponse(pixel_bytes, media_type="image/png")
+    return Response(content=PIXEL, media_type="image/gif", headers=PIXEL_HEADERS)
 
 
 @router.get("/unsubscribe/{token}")
-async def unsubscribe_from_email(token: str, session: Session = Depends(get_session)):
+async def unsubscribe_from_email(
+    token: str, session: AsyncSession = Depends(get_async_session)
+):
     contact_id = confirm_token(token)
     logger.info(f"Receive unsubscribe request from : {contact_id}")
-    contact = crud_mail.get(session=session, id=contact_id)
-    contact.status = "unsubscribed"
-    session.add(contact)
-    session.commit()
+    contact = await crud_contact.get_async(session=session, id=contact_id)
+    if contact.status != "unsubscribed":
+        contact.status = "unsubscribed"
+        session.add(contact)
+        await session.execute(
+            CampaignStats.incr_for_contact(contact.id, unsubscribed=1)
+        )
+        await session.run_sync(
+            suppress, [contact.email], SuppressionReason.unsubscribed
+        )
+        await session.commit()
+        mirror_suppress([contact.email])
+        invalidate_contacts([contact.id])
     html_content = """
     <html>
         <body>
@@ -0,0 +1,6 @@
+import redis
+
+from settings import settings
+
+
+redis_client = redis.Redis.from_url(settings.REDISCLOUD_URL, decode_responses=True)
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+import redis
+from loguru import logger
+from sqlmodel import Session, select
+
+from app.cache import redis_client
+from app.models import Contact
+from settings import settings
+
+
+# the API publishes here the ids of the contacts it changes (null for all)
+CONTACTS_INVALIDATED_CHANNEL = "contacts:invalidated"
+
+
+def contact_record(contact: Contact) -> dict:
+    """What the worker needs of a contact, shipped with the tasks and kept in
+    the contact cache, `fetched_at` telling how fresh it is."""
+    return {
+        "id": contact.id,
+        "email": contact.email,
+        "meta": contact.meta,
+        "status": contact.status,
+        "fetched_at": time.time(),
+    }
+
+
+def invalidate_contacts(ids: Optional[List[int]] = None):
+    message = {"ids": ids, "at": time.time()}
+    redis_client.publish(CONTACTS_INVALIDATED_CHANNEL, json.dumps(message))
+
+
+class ContactCache(object):
+    """Per-process LRU of contact records.
+
+    Records are kept `ttl` seconds at most, and dropped as soon as the
+    invalidation of their contact is received, the invalidations being read
+    from the redis channel before each lookup. The TTL bounds the staleness
+    of the records fetched before the process subscribed.
+    """
+
+    def __init__(self, client: redis.Redis, maxsize: int = 10000, ttl: float = 300):
+        self.client = client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._contacts = OrderedDict()
+        self._invalidated = {}
+        self._cleared_at = 0
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._pubsub_pid = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _subscribe(self):
+        # like the SMTP pool, the subscription is not shared across forks
+        if self._pubsub is None or self._pubsub_pid != os.getpid():
+            self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(CONTACTS_INVALIDATED_CHANNEL)
+            self._pubsub_pid = os.getpid()
+        return self._pubsub
+
+    def _invalidate(self, ids: Optional[List[int]], at: float):
+        self.stats["invalidations"] += 1
+        if ids is None:
+            self._contacts.clear()
+            self._invalidated.clear()
+            self._cleared_at = at
+            return
+        for id in ids:
+            self._contacts.pop(id, None)
+            self._invalidated[id] = at
+
+    def drain(self):
+        """Applies the invalidations received since the last lookup."""
+        try:
+            pubsub = self._subscribe()
+            message = pubsub.get_message()
+            while message:
+                data = json.loads(message["data"])
+                self._invalidate(data["ids"], data["at"])
+                message = pubsub.get_message()
+        except redis.RedisError as e:
+            # invalidations may have been missed
+            logger.warning(f"Contact cache cleared, cannot read invalidations : {e}")
+            self._pubsub = None
+            self._invalidate(None, time.time())
+
+        # forget the invalidations older than any record we can still accept
+        expired = time.time() - self.ttl
+        if len(self._invalidated) > self.maxsize:
+            self._invalidated = {
+                id: at for id, at in self._invalidated.items() if at > expired
+            }
+
+    def _fresh(self, record: dict) -> bool:
+        fetched_at = record["fetched_at"]
+        return (
+            fetched_at > time.time() - self.ttl
+            and fetched_at > self._cleared_at
+            and fetched_at > self._invalidated.get(record["id"], 0)
+        )
+
+    def _put(self, record: dict):
+        self._contacts[record["id"]] = record
+        self._contacts.move_to_end(record["id"])
+        if len(self._contacts) > self.maxsize:
+            self._contacts.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get_many(
+        self, session: Session, ids: List[int], prefetched: Iterable[dict] = ()
+    ) -> Dict[int, dict]:
+        """Returns the records of the contacts by id, from the records shipped
+        with the task or the cache, the others being loaded in one query.
+        Deleted contacts are missing from the result."""
+        with self._lock:
+            self.drain()
+            for record in prefetched:
+                if self._fresh(record):
+                    self._put(record)
+
+            records, missing = {}, []
+            for id in ids:
+                record = self._contacts.get(id)
+                if record is not None and self._fresh(record):
+                    self._contacts.move_to_end(id)
+                    records[id] = record
+                    self.stats["hits"] += 1
+                else:
+                    missing.append(id)
+                    self.stats["misses"] += 1
+
+        if missing:
+            contacts = session.exec(select(Contact).where(Contact.id.in_(missing))).all()
+            with self._lock:
+                for contact in contacts:
+                    record = contact_record(contact)
+                    self._put(record)
+                    records[contact.id] = record
+        return records
+
+    def get(self, session: Session, id: int, prefetched: dict = None) -> Optional[dict]:
+        records = self.get_many(session, [id], [prefetched] if prefetched else ())
+        return records.get(id)
+
+
+contact_cache = ContactCache(
+    redis_client, maxsize=settings.CONTACT_CACHE_SIZE, ttl=settings.CONTACT_CACHE_TTL
+)
@@ -1,9 +1,28 @@
-from fastapi import HTTPException, Query
-from sqlmodel import select, SQLModel
-from typing import List
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from sqlalchemy import bindparam, or_
+from sqlmodel import delete, func, literal, select, update, SQLModel
+from typing import Dict, List, Optional, Set, Tuple
 
-from app.db import Session
-from app.models import Contact
+from app.db import AsyncSession, Session, in_ids, upsert
+from app.models import (
+    CampaignRead,
+    CampaignReadWithChanges,
+    CampaignStats,
+    CampaignStatsRead,
+    Contact,
+    ContactCampaignLink,
+    CLAIMABLE_MAIL_STATUSES,
+    Mail,
+    MailStatus,
+    SegmentDefinition,
+    SuppressionReason,
+)
+from app.segments import InvalidPredicate, segment_clause
+from app.suppression import mirror_suppress, mirror_unsuppress, suppress, unsuppress
+from app.utils import chunked
+from settings import settings
 
 
 class CRUDBase(object):
@@ -16,10 +35,42 @@ class CRUDBase(object):
             raise HTTPException(status_code=404, detail="Object not found")
         return obj
 
+    async def get_async(self, session: AsyncSession, id: int):
+        obj = await session.get(self.model, id)
+        if not obj:
+            raise HTTPException(status_code=404, detail="Object not found")
+        return obj
+
+    def paginate(self, statement, after_id: int = None, offset: int = 0, limit: int = 20):
+        # keyset pagination, ordered by primary key
+        if after_id is not None:
+            statement = statement.where(self.model.id > after_id)
+        return statement.order_by(self.model.id).offset(offset).limit(limit)
+
+    def multi_statement(self, after_id: int = None, offset: int = 0, limit: int = 20):
+        return self.paginate(select(self.model), after_id, offset, limit)
+
     def get_multi(
-        self, session: Session, offset: int = 0, limit: int = Query(default=20, lte=100)
+        self,
+        session: Session,
+        after_id: int = None,
+        offset: int = 0,
+        limit: int = 20,
+        **filters,
     ):
-        return session.exec(select(self.model).offset(offset).limit(limit)).all()
+        statement = self.multi_statement(after_id, offset, limit, **filters)
+        return session.exec(statement).all()
+
+    async def get_multi_async(
+        self,
+        session: AsyncSession,
+        after_id: int = None,
+        offset: int = 0,
+        limit: int = 20,
+        **filters,
+    ):
+        statement = self.multi_statement(after_id, offset, limit, **filters)
+        return (await session.exec(statement)).all()
 
     def update(self, session: Session, id: int, obj: SQLModel):
         db_obj = session.get(self.model, id)
@@ -63,68 +114,253 @@ class CRUDContact(CRUDBase):
     def get_by_email(self, session: Session, email: str):
         return session.exec(select(Contact).where(Contact.email == email)).one()
 
+    def multi_statement(
+        self,
+        after_id: int = None,
+        offset: int = 0,
+        limit: int = 20,
+        campaign_id: int = None,
+    ):
+        statement = select(self.model)
+        if campaign_id:
+            statement = statement.join(
+                ContactCampaignLink, ContactCampaignLink.contact_id == self.model.id
+            ).where(ContactCampaignLink.campaign_id == campaign_id)
+        return self.paginate(statement, after_id, offset, limit)
+
+    def upsert_multi(
+        self, session: Session, objs: List[SQLModel], update_existing: bool = False
+    ) -> int:
+        """Inserts contacts in one statement, skipping (or updating the meta of)
+        the ones whose email already exists. Returns the number of rows written."""
+        if not objs:
+            return 0
 
-class CRUDCampaign(CRUDBase):
+        statement = upsert(session, self.model).values([obj.dict() for obj in objs])
+        if update_existing:
+            statement = statement.on_conflict_do_update(
+                index_elements=["email"], set_={"meta": statement.excluded.meta}
+            )
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=["email"])
+
+        result = session.execute(statement)
+        session.commit()
+        return result.rowcount
+
+
+def segment_where(session: Session, definition: SegmentDefinition):
+    try:
+        return segment_clause(definition, dialect=session.get_bind().dialect.name)
+    except InvalidPredicate as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+class CRUDSegment(CRUDBase):
     def __init__(self, model: SQLModel):
         super().__init__(model)
 
     def create(self, session: Session, obj: SQLModel):
-        db_obj = self.model.from_orm(obj)
+        segment_where(session, obj.definition)
+        db_obj = self.model(name=obj.name, definition=obj.definition.dict())
+        session.add(db_obj)
+        session.commit()
+        session.refresh(db_obj)
+        return db_obj
+
+    def count(self, session: Session, definition: SegmentDefinition) -> int:
+        return session.exec(
+            select(func.count(Contact.id)).where(segment_where(session, definition))
+        ).one()
+
+
+class CRUDSuppression(CRUDBase):
+    def __init__(self, model: SQLModel):
+        super().__init__(model)
+
+    def create_multi(
+        self, session: Session, emails: List[str], reason: SuppressionReason
+    ) -> int:
+        added = suppress(session, emails, reason)
+        if reason == SuppressionReason.unsubscribed:
+            # keep the contacts' status in line with an imported unsubscribe list
+            for chunk in chunked(emails, settings.CONTACT_IMPORT_CHUNK_SIZE):
+                session.execute(
+                    update(Contact)
+                    .where(Contact.email.in_(chunk))
+                    .values(status="unsubscribed")
+                    .execution_options(synchronize_session=False)
+                )
+        session.commit()
+        mirror_suppress(emails)
+        return added
+
+    def delete(self, session: Session, id: int):
+        email = self.get(session=session, id=id).email
+        unsuppress(session, email)
+        session.commit()
+        mirror_unsuppress(email)
 
-        obj_data = obj.dict(exclude_unset=True)
-        if "contacts_ids_to_add" in obj_data:
-            contacts = session.exec(
-                select(Contact).where(Contact.id.in_(obj_data["contacts_ids_to_add"]))
-            ).all()
-            db_obj.contacts.extend(contacts)
 
+class CRUDCampaign(CRUDBase):
+    def __init__(self, model: SQLModel):
+        super().__init__(model)
+
+    def multi_statement(self, after_id: int = None, offset: int = 0, limit: int = 20):
+        statement = select(self.model, self.model.contact_count_column())
+        return self.paginate(statement, after_id, offset, limit)
+
+    def get_read(self, session: Session, id: int) -> CampaignRead:
+        # the campaign with its number of contacts, without loading them
+        row = session.exec(
+            select(self.model, self.model.contact_count_column()).where(self.model.id == id)
+        ).first()
+        if not row:
+            raise HTTPException(status_code=404, detail="Object not found")
+        campaign, contact_count = row
+        return CampaignRead(**campaign.dict(), contact_count=contact_count)
+
+    async def get_multi_async(
+        self,
+        session: AsyncSession,
+        after_id: int = None,
+        offset: int = 0,
+        limit: int = 20,
+    ):
+        rows = await super().get_multi_async(session, after_id, offset, limit)
+        return [
+            CampaignRead(**campaign.dict(), contact_count=contact_count)
+            for campaign, contact_count in rows
+        ]
+
+    def contact_count(self, session: Session, id: int) -> int:
+        return session.exec(
+            select(func.count(ContactCampaignLink.contact_id)).where(
+                ContactCampaignLink.campaign_id == id
+            )
+        ).one()
+
+    def create(self, session: Session, obj: SQLModel):
+        db_obj = self.model.from_orm(obj)
+        db_obj.stats = CampaignStats()
         session.add(db_obj)
+        session.flush()
+
+        contacts_added = self.add_contacts(
+            session=session, id=db_obj.id, contact_ids=obj.contacts_ids_to_add
+        )
         session.commit()
         session.refresh(db_obj)
-        return db_obj
+        return CampaignReadWithChanges(
+            **db_obj.dict(),
+            contact_count=self.contact_count(session=session, id=db_obj.id),
+            contacts_added=contacts_added,
+        )
+
+    def add_contacts(self, session: Session, id: int, contact_ids: List[int]) -> int:
+        """Links existing contacts to the campaign, skipping the ones already
+        linked, without loading either side. Returns the number of links added."""
+        added = 0
+        for ids in chunked(set(contact_ids), settings.CONTACT_IMPORT_CHUNK_SIZE):
+            statement = (
+                upsert(session, ContactCampaignLink)
+                .from_select(
+                    ["campaign_id", "contact_id"],
+                    select(literal(id), Contact.id).where(
+                        in_ids(session, Contact.id, ids)
+                    ),
+                )
+                .on_conflict_do_nothing()
+            )
+            added += session.execute(statement).rowcount
+        return added
+
+    def remove_contacts(self, session: Session, id: int, contact_ids: List[int]) -> int:
+        removed = 0
+        for ids in chunked(set(contact_ids), settings.CONTACT_IMPORT_CHUNK_SIZE):
+            statement = delete(ContactCampaignLink).where(
+                ContactCampaignLink.campaign_id == id,
+                in_ids(session, ContactCampaignLink.contact_id, ids),
+            )
+            removed += session.execute(statement).rowcount
+        return removed
+
+    def add_segment(
+        self, session: Session, id: int, definition: SegmentDefinition
+    ) -> int:
+        """Adds the contacts matching a segment to the campaign with a single
+        INSERT ... SELECT. Returns the number of contacts added."""
+        campaign = self.get(session=session, id=id)
+        statement = (
+            upsert(session, ContactCampaignLink)
+            .from_select(
+                ["campaign_id", "contact_id"],
+                select(literal(campaign.id), Contact.id).where(
+                    segment_where(session, definition)
+                ),
+            )
+            .on_conflict_do_nothing()
+        )
+        result = session.execute(statement)
+        session.commit()
+        return result.rowcount
+
+    def get_stats(self, session: Session, id: int):
+        stats = session.get(CampaignStats, id)
+        if stats:
+            return CampaignStatsRead.from_counts(**stats.dict(exclude={"campaign_id"}))
+
+        # campaigns created before the counters existed
+        self.get(session=session, id=id)
+        counts = session.exec(Mail.campaign_stats(campaign_id=id)).one()
+        return CampaignStatsRead.from_counts(**counts._asdict())
+
+    async def get_stats_async(self, session: AsyncSession, id: int):
+        stats = await session.get(CampaignStats, id)
+        if stats:
+            return CampaignStatsRead.from_counts(**stats.dict(exclude={"campaign_id"}))
+
+        await self.get_async(session=session, id=id)
+        counts = (await session.exec(Mail.campaign_stats(campaign_id=id))).one()
+        return CampaignStatsRead.from_counts(**counts._asdict())
 
     def update(self, session: Session, id: int, obj: SQLModel):
         db_obj = session.get(self.model, id)
         if not db_obj:
             raise HTTPException(status_code=404, detail="Object not found")
 
-        obj_data = obj.dict(exclude_unset=True)
+        obj_data = obj.dict(
+            exclude_unset=True, exclude={"contacts_ids_to_add", "contacts_ids_to_remove"}
+        )
         for key, value in obj_data.items():
-            try:
-                setattr(db_obj, key, value)
-            except ValueError:
-                continue
-
-        if "contacts_ids_to_add" in obj_data:
-            contacts = session.exec(
-                select(Contact).where(Contact.id.in_(obj_data["contacts_ids_to_add"]))
-            ).all()
-            db_obj.contacts.extend(contacts)
-
-        if "contacts_ids_to_remove" in obj_data:
-            contacts = session.exec(
-                select(Contact).where(
-                    Contact.id.in_(obj_data["contacts_ids_to_remove"])
-                )
-            ).all()
-            for c in contacts:
-                db_obj.contacts.remove(c)
-
+            setattr(db_obj, key, value)
         session.add(db_obj)
+
+        contacts_added = self.add_contacts(
+            session=session, id=id, contact_ids=obj.contacts_ids_to_add
+        )
+        contacts_removed = self.remove_contacts(
+            session=session, id=id, contact_ids=obj.contacts_ids_to_remove
+        )
         session.commit()
         session.refresh(db_obj)
-        return db_obj
+        return CampaignReadWithChanges(
+            **db_obj.dict(),
+            contact_count=self.contact_count(session=session, id=id),
+            contacts_added=contacts_added,
+            contacts_removed=contacts_removed,
+        )
 
 
 class CRUDMail(CRUDBase):
     def __init__(self, model: SQLModel):
         super().__init__(model)
 
-    def get_multi(
+    def multi_statement(
         self,
-        session: Session,
+        after_id: int = None,
         offset: int = 0,
-        limit: int = Query(default=20, lte=100),
+        limit: int = 20,
         contact_id: int = None,
         campaign_id: int = None,
     ):
@@ -133,7 +369,273 @@ class CRUDMail(CRUDBase):
             statement = statement.where(self.model.contact_id == contact_id)
         if campaign_id:
             statement = statement.where(self.model.campaign_id == campaign_id)
-        return session.exec(statement.offset(offset).limit(limit)).all()
+        return self.paginate(statement, after_id, offset, limit)
+
+    def queue(self, session: Session, mails: List[dict]) -> List[int]:
+        """Creates the mails not created yet, by idempotency key, and returns
+        the ids of the ones still to send."""
+        if not mails:
+            return []
+        session.execute(
+            upsert(session, self.model)
+            .values([{"status": MailStatus.queued, **mail} for mail in mails])
+            .on_conflict_do_nothing(index_elements=["idempotency_key"])
+        )
+        return session.exec(
+            select(self.model.id)
+            .where(
+                self.model.idempotency_key.in_([m["idempotency_key"] for m in mails]),
+                self.model.status.in_(CLAIMABLE_MAIL_STATUSES),
+            )
+            .order_by(self.model.id)
+        ).all()
+
+    def create_once(self, session: Session, mail: dict):
+        """Creates a mail unless one exists with its idempotency key. Returns
+        the mail, and whether it was created."""
+        result = session.execute(
+            upsert(session, self.model)
+            .values(status=MailStatus.queued, **mail)
+            .on_conflict_do_nothing(index_elements=["idempotency_key"])
+        )
+        session.commit()
+        db_mail = session.exec(
+            select(self.model).where(
+                self.model.idempotency_key == mail["idempotency_key"]
+            )
+        ).one()
+        return db_mail, bool(result.rowcount)
+
+    def claim(self, session: Session, ids: List[int], claimed_at: datetime):
+        """Moves the given mails that are queued or deferred to `sending`, and
+        returns them (id, contact and content). Committed right away, so that
+        a retried or concurrent task never sends the same mail twice.
+
+        `claimed_at` identifies the claim: the mails' statuses are only
+        written back while they still hold it (see `owned`)."""
+        mails = session.exec(
+            select(
+                self.model.id,
+                self.model.contact_id,
+                self.model.campaign_id,
+                self.model.subject,
+                self.model.sender_name,
+                self.model.html_template,
+                self.model.attempts,
+            )
+            .where(
+                in_ids(session, self.model.id, ids),
+                self.model.status.in_(CLAIMABLE_MAIL_STATUSES),
+            )
+            .order_by(self.model.id)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if mails:
+            session.execute(
+                update(self.model)
+                .where(in_ids(session, self.model.id, [mail.id for mail in mails]))
+                .values(status=MailStatus.sending, claimed_at=claimed_at)
+                .execution_options(synchronize_session=False)
+            )
+        session.commit()
+        return mails
+
+    def owned(self, claimed_at: datetime) -> tuple:
+        """Matches the mails still held by the claim made at `claimed_at`, not
+        reaped meanwhile."""
+        return (
+            self.model.status == MailStatus.sending,
+            self.model.claimed_at == claimed_at,
+        )
+
+    def held(self, session: Session, ids: List[int], claimed_at: datetime) -> Set[int]:
+        """The given mails still held by the claim, locked until the caller
+        commits, so that the reaper cannot take them meanwhile."""
+        return set(
+            session.exec(
+                select(self.model.id)
+                .where(in_ids(session, self.model.id, ids), *self.owned(claimed_at))
+                .with_for_update()
+            ).all()
+        )
+
+    def renew_claim(
+        self, session: Session, ids: List[int], claimed_at: datetime
+    ) -> Tuple[Set[int], datetime]:
+        """Extends the claim of the mails still held, so that the reaper
+        leaves a long batch alone. Returns their ids and the new claim time,
+        which identifies the claim from then on."""
+        renewed_at = datetime.now(timezone.utc)
+        held = self.held(session, ids, claimed_at)
+        if held:
+            session.execute(
+                update(self.model)
+                .where(in_ids(session, self.model.id, list(held)))
+                .values(claimed_at=renewed_at)
+                .execution_options(synchronize_session=False)
+            )
+        session.commit()
+        return held, renewed_at
+
+    def reap(self, session: Session, timeout: int) -> Tuple[int, int]:
+        """Moves the mails `sending` for more than `timeout` seconds back to
+        `deferred`, due right away, counting an attempt; the ones out of
+        attempts are failed, and counted in their campaigns' stats. Returns
+        both counts; the caller commits."""
+        now = datetime.now(timezone.utc)
+        stale = (
+            self.model.status == MailStatus.sending,
+            or_(
+                self.model.claimed_at < now - timedelta(seconds=timeout),
+                # claimed before claimed_at was recorded
+                self.model.claimed_at.is_(None),
+            ),
+        )
+        out_of_attempts = self.model.attempts + 1 >= settings.DEFERRAL_MAX_ATTEMPTS
+
+        failing = session.exec(
+            select(self.model.id, self.model.campaign_id)
+            .where(*stale, out_of_attempts)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if failing:
+            session.execute(
+                update(self.model)
+                .where(in_ids(session, self.model.id, [mail.id for mail in failing]))
+                .values(status=MailStatus.failed, attempts=self.model.attempts + 1)
+                .execution_options(synchronize_session=False)
+            )
+            by_campaign = Counter(mail.campaign_id for mail in failing)
+            for campaign_id, failed in by_campaign.items():
+                CampaignStats.incr(session, campaign_id, mails=failed, failed=failed)
+
+        deferred = session.execute(
+            update(self.model)
+            .where(*stale)
+            .values(
+                status=MailStatus.deferred,
+                scheduled_at=now,
+                attempts=self.model.attempts + 1,
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        return deferred, len(failing)
+
+    def set_status(
+        self,
+        session: Session,
+        status: MailStatus,
+        sent_at: Dict[int, Optional[datetime]],
+        claimed_at: datetime,
+    ):
+        """Moves the mails (the keys of `sent_at`) held by the claim to
+        `status` in one executemany, writing their sending time."""
+        if not sent_at:
+            return
+        session.execute(
+            update(self.model)
+            .where(self.model.id == bindparam("mail_id"), *self.owned(claimed_at))
+            .values(status=status, time_send=bindparam("sent_at"))
+            .execution_options(synchronize_session=False),
+            [{"mail_id": id, "sent_at": at} for id, at in sent_at.items()],
+        )
+
+    def defer(
+        self,
+        session: Session,
+        until: Dict[int, datetime],
+        claimed_at: datetime,
+        attempt: bool = False,
+    ):
+        """Moves the mails (the keys of `until`) held by the claim back to
+        `deferred`, for the dispatcher to enqueue them again at the given
+        times. `attempt` counts a temporary failure."""
+        if not until:
+            return
+        values = {"status": MailStatus.deferred, "scheduled_at": bindparam("until")}
+        if attempt:
+            values["attempts"] = self.model.attempts + 1
+        session.execute(
+            update(self.model)
+            .where(self.model.id == bindparam("mail_id"), *self.owned(claimed_at))
+            .values(**values)
+            .execution_options(synchronize_session=False),
+            [{"mail_id": id, "until": at} for id, at in until.items()],
+        )
+
+    def scheduled(self, id: int) -> tuple:
+        """Matches the mail if it is scheduled through `POST /mails` and not
+        dispatched yet; deferred mails, retried at their `scheduled_at`, are
+        not `queued`."""
+        return (
+            self.model.id == id,
+            self.model.scheduled_at.isnot(None),
+            self.model.status == MailStatus.queued,
+        )
+
+    def reschedule(self, session: Session, id: int, scheduled_at: datetime) -> Mail:
+        # the dispatcher holds the rows it claims, so this waits for it and
+        # then only matches if the mail was not enqueued meanwhile
+        result = session.execute(
+            update(self.model)
+            .where(*self.scheduled(id))
+            .values(scheduled_at=scheduled_at)
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            self.get(session=session, id=id)
+            raise HTTPException(status_code=409, detail="Mail already dispatched")
+        session.commit()
+        return self.get(session=session, id=id)
+
+    def cancel(self, session: Session, id: int):
+        result = session.execute(
+            delete(self.model)
+            .where(*self.scheduled(id))
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            self.get(session=session, id=id)
+            raise HTTPException(status_code=409, detail="Mail already dispatched")
+        session.commit()
+
+    def claim_due(self, session: Session, limit: int) -> List[Mail]:
+        """Locks a batch of the mails due, skipping the ones locked by another
+        dispatcher, and takes them out of the schedule. They stay locked until
+        the caller commits, once they are enqueued."""
+        mails = session.exec(
+            select(self.model)
+            .where(self.model.scheduled_at <= datetime.now(timezone.utc))
+            .order_by(self.model.scheduled_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ).all()
+        for mail in mails:
+            mail.scheduled_at = None
+            session.add(mail)
+        return mails
+
+    def mark_opened(self, session: Session, ids: List[int]) -> int:
+        """Flags a batch of mails as opened and updates their campaigns'
+        counters. Returns the number of mails opened for the first time."""
+        not_opened = (self.model.id.in_(ids), self.model.is_open.isnot(True))
+
+        opened_by_campaign = session.exec(
+            select(self.model.campaign_id, func.count(self.model.id))
+            .where(*not_opened)
+            .group_by(self.model.campaign_id)
+        ).all()
+        session.execute(
+            update(self.model)
+            .where(*not_opened)
+            .values(is_open=True)
+            .execution_options(synchronize_session=False)
+        )
+        for campaign_id, opened in opened_by_campaign:
+            CampaignStats.incr(session, campaign_id, opened=opened)
+        session.commit()
+
+        return sum(opened for _, opened in opened_by_campaign)
 
     def update(self, session: Session, id: int, obj: SQLModel):
         db_obj = session.get(self.model, id)
@@ -1,11 +1,53 @@
-from sqlmodel import create_engine, Session
+from sqlalchemy import Integer, any_, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import create_engine, Session, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from settings import settings
 
 
-engine = create_engine(settings.DATABASE_URL)
+def pool_options(url: str) -> dict:
+    # sqlite (used for local runs) does not use a QueuePool
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+engine = create_engine(settings.DATABASE_URL, **pool_options(settings.DATABASE_URL))
+async_engine = create_async_engine(
+    settings.ASYNC_DATABASE_URL, **pool_options(settings.ASYNC_DATABASE_URL)
+)
 
 
 def get_session() -> Session:
     with Session(engine) as session:
         yield session
+
+
+async def get_async_session() -> AsyncSession:
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+def upsert(session: Session, model: SQLModel):
+    """Returns an INSERT supporting ON CONFLICT clauses for the session's database."""
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(model.__table__)
+    return sqlite.insert(model.__table__)
+
+
+def in_ids(session: Session, column, ids: list):
+    """`column IN ids`, bound as a single array parameter (`= ANY(...)`) on
+    postgresql instead of one parameter per id."""
+    if session.get_bind().dialect.name == "postgresql":
+        return column == any_(
+            bindparam(None, list(ids), type_=postgresql.ARRAY(Integer))
+        )
+    return column.in_(ids)
@@ -0,0 +1,225 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import aiosmtplib
+from loguru import logger
+
+from app.smtp import SMTPResult
+from settings import SenderAccount, settings
+
+
+class AsyncPooledConnection(object):
+    def __init__(self, client: aiosmtplib.SMTP):
+        self.client = client
+        self.created_at = time.monotonic()
+        self.messages = 0
+
+    async def close(self):
+        try:
+            await self.client.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            self.client.close()
+
+
+class AsyncSMTPPool(object):
+    """asyncio counterpart of `app.smtp.SMTPConnectionPool`: up to
+    `max_connections` SMTP sessions are used concurrently, each of them
+    recycled after `max_messages` messages or `max_age` seconds.
+
+    Must only be used from the event loop running it.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        ssl: bool,
+        user: str,
+        password: str,
+        max_connections: int = 8,
+        max_messages: int = 100,
+        max_age: int = 300,
+        timeout: int = 30,
+    ):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.user = user
+        self.password = password
+        self.max_connections = max_connections
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.timeout = timeout
+
+        self._idle: List[AsyncPooledConnection] = []
+        # created in the loop, see acquire
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.stats = {"hits": 0, "misses": 0, "reconnects": 0, "recycled": 0}
+
+    async def _connect(self) -> AsyncPooledConnection:
+        client = aiosmtplib.SMTP(
+            hostname=self.host, port=self.port, use_tls=self.ssl, timeout=self.timeout
+        )
+        await client.connect()
+        if self.user and self.password:
+            await client.login(self.user, self.password)
+        return AsyncPooledConnection(client)
+
+    def _expired(self, conn: AsyncPooledConnection) -> bool:
+        return (
+            conn.messages >= self.max_messages
+            or time.monotonic() - conn.created_at >= self.max_age
+        )
+
+    async def acquire(self) -> AsyncPooledConnection:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        await self._slots.acquire()
+
+        while self._idle:
+            conn = self._idle.pop()
+            if not self._expired(conn):
+                self.stats["hits"] += 1
+                return conn
+            self.stats["recycled"] += 1
+            await conn.close()
+        self.stats["misses"] += 1
+
+        try:
+            return await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, conn: AsyncPooledConnection, discard: bool = False):
+        try:
+            if discard or self._expired(conn):
+                if not discard:
+                    self.stats["recycled"] += 1
+                await conn.close()
+            else:
+                self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    async def _sendmail(self, conn: AsyncPooledConnection, from_addr: str, to_addrs, msg: str):
+        refused, _ = await conn.client.sendmail(from_addr, to_addrs, msg)
+        conn.messages += 1
+        if refused:
+            response = next(iter(refused.values()))
+            return SMTPResult(response.code, response.message)
+        return SMTPResult(250, "OK")
+
+    async def sendmail(self, from_addr: str, to_addrs, msg: str) -> SMTPResult:
+        try:
+            conn = await self.acquire()
+        except (aiosmtplib.SMTPException, OSError) as e:
+            logger.warning(f"Cannot connect to {self.host}: {e}")
+            return SMTPResult(None, str(e), error=e)
+
+        try:
+            try:
+                result = await self._sendmail(conn, from_addr, to_addrs, msg)
+            except (aiosmtplib.SMTPServerDisconnected, OSError):
+                # stale connection (idle timeout on the server side), retry once
+                conn.client.close()
+                self.stats["reconnects"] += 1
+                conn = await self._connect()
+                result = await self._sendmail(conn, from_addr, to_addrs, msg)
+        except aiosmtplib.SMTPRecipientsRefused as e:
+            await self.release(conn)
+            refused = e.recipients[0]
+            return SMTPResult(refused.code, refused.message, error=e)
+        except aiosmtplib.SMTPResponseException as e:
+            await self.release(conn, discard=e.code == 421)
+            return SMTPResult(e.code, e.message, error=e)
+        except (aiosmtplib.SMTPException, OSError) as e:
+            await self.release(conn, discard=True)
+            logger.warning(f"SMTP error on {self.host}: {e}")
+            return SMTPResult(None, str(e), error=e)
+
+        await self.release(conn)
+        return result
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await conn.close()
+
+
+class DeliveryEngine(object):
+    """Sends mails from synchronous code (the Celery tasks) over asyncio
+    SMTP pools running in a background thread, one per sender address, so
+    that a single worker process has many messages in flight.
+
+    `submit` returns a future right away, unless `max_pending` messages are
+    already in flight: it then blocks until one of them is done, which
+    keeps the rendering from running ahead of the SMTP sessions.
+    """
+
+    def __init__(self, pools: Dict[str, AsyncSMTPPool], max_pending: int = 100):
+        self.pools = pools
+        self.max_pending = max_pending
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="smtp-delivery", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, from_addr: str, to_addrs, msg: str) -> Future:
+        self._pending.acquire()
+        future = asyncio.run_coroutine_threadsafe(
+            self.pools[from_addr].sendmail(from_addr, to_addrs, msg), self._loop
+        )
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def sendmail(self, from_addr: str, to_addrs, msg: str) -> SMTPResult:
+        return self.submit(from_addr, to_addrs, msg).result()
+
+    async def _close_pools(self):
+        for pool in self.pools.values():
+            await pool.close()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close_pools(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+_engine: Optional[DeliveryEngine] = None
+_engine_pid: Optional[int] = None
+
+
+def async_smtp_pool(account: SenderAccount) -> AsyncSMTPPool:
+    return AsyncSMTPPool(
+        host=account.smtp_host,
+        port=account.smtp_port,
+        ssl=account.smtp_ssl,
+        user=account.address,
+        password=account.password,
+        max_connections=settings.SMTP_ASYNC_CONNECTIONS,
+        max_messages=settings.SMTP_POOL_MAX_MESSAGES,
+        max_age=settings.SMTP_POOL_MAX_AGE,
+        timeout=settings.SMTP_TIMEOUT,
+    )
+
+
+def get_delivery_engine() -> DeliveryEngine:
+    """Returns the delivery engine of the current process (rebuilt after a
+    fork, the loop thread not surviving it)."""
+    global _engine, _engine_pid
+
+    if _engine is None or _engine_pid != os.getpid():
+        pools = {
+            account.address: async_smtp_pool(account)
+            for account in settings.SENDER_ACCOUNTS
+        }
+        _engine = DeliveryEngine(pools, max_pending=settings.SMTP_ASYNC_MAX_PENDING)
+        _engine_pid = os.getpid()
+    return _engine
@@ -0,0 +1,16 @@
+from typing import List
+
+from app.cache import redis_client
+
+
+# ids of the mails opened since the last flush, a set so that repeated
+# opens of the same mail are only written once
+OPENED_MAILS_KEY = "mails:opened"
+
+
+def record_open(mail_id: int):
+    redis_client.sadd(OPENED_MAILS_KEY, mail_id)
+
+
+def pop_opens(count: int) -> List[int]:
+    return [int(mail_id) for mail_id in redis_client.spop(OPENED_MAILS_KEY, count)]
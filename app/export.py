@@ -0,0 +1,61 @@
+import csv
+import io
+import json
+from datetime import datetime
+from enum import Enum
+from fastapi.responses import StreamingResponse
+from typing import Iterator, List
+
+from app.db import Session, engine
+from settings import settings
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+MEDIA_TYPES = {ExportFormat.ndjson: "application/x-ndjson", ExportFormat.csv: "text/csv"}
+
+
+def to_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value)} is not JSON serializable")
+
+
+def export_lines(statement, columns: List[str], format: ExportFormat) -> Iterator[str]:
+    """Yields the rows of `statement` serialized, by chunks of EXPORT_BATCH_SIZE
+    rows fetched from a server-side cursor, so memory stays constant."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == ExportFormat.csv:
+        writer.writerow(columns)
+
+    statement = statement.execution_options(
+        stream_results=True, yield_per=settings.EXPORT_BATCH_SIZE
+    )
+    with Session(engine) as session:
+        for rows in session.execute(statement).partitions(settings.EXPORT_BATCH_SIZE):
+            for row in rows:
+                if format == ExportFormat.csv:
+                    writer.writerow(
+                        json.dumps(v) if isinstance(v, (dict, list)) else v for v in row
+                    )
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, row)), default=to_json))
+                    buffer.write("\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_response(statement, columns: List[str], format: ExportFormat, name: str):
+    return StreamingResponse(
+        export_lines(statement, columns, format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{format.value}"'},
+    )
@@ -0,0 +1,49 @@
+from math import ceil
+from typing import Dict, List
+
+from app.cache import redis_client
+from settings import settings
+
+
+# classes of traffic, each with its own celery queue: the one-off mails of
+# `POST /mails` and the campaigns' fan-out
+TRANSACTIONAL = "transactional"
+BULK = "bulk"
+MAIL_CLASSES = (TRANSACTIONAL, BULK)
+
+
+def latency_key(mail_class: str) -> str:
+    return f"latency:{mail_class}"
+
+
+def record_latencies(mail_class: str, latencies: List[float]):
+    """Keeps the last `LATENCY_SAMPLES` enqueue-to-SMTP latencies (seconds)
+    of the class."""
+    if not latencies:
+        return
+    key = latency_key(mail_class)
+    pipe = redis_client.pipeline()
+    pipe.lpush(key, *[f"{latency:.3f}" for latency in latencies])
+    pipe.ltrim(key, 0, settings.LATENCY_SAMPLES - 1)
+    pipe.execute()
+
+
+def percentile(samples: List[float], p: float) -> float:
+    """Nearest-rank percentile of sorted samples."""
+    return samples[max(ceil(p / 100 * len(samples)) - 1, 0)]
+
+
+def get_latencies() -> Dict[str, Dict]:
+    pipe = redis_client.pipeline()
+    for mail_class in MAIL_CLASSES:
+        pipe.lrange(latency_key(mail_class), 0, -1)
+
+    latencies = {}
+    for mail_class, samples in zip(MAIL_CLASSES, pipe.execute()):
+        samples = sorted(float(s) for s in samples)
+        latencies[mail_class] = {
+            "samples": len(samples),
+            "p50": percentile(samples, 50) if samples else None,
+            "p99": percentile(samples, 99) if samples else None,
+        }
+    return latencies
@@ -1,42 +1,170 @@
 import emails
-from emails.template import JinjaTemplate as T
-from lxml import html
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from jinja2 import Environment, TemplateSyntaxError
+from lxml import etree, html
+from typing import Optional, Tuple
 
+from app.delivery import get_delivery_engine
+from app.smtp import SMTPResult, get_smtp_pool
 from app.utils import generate_confirmation_token
-from settings import settings
+from settings import SenderAccount, settings
 
 
-def add_unsubscribe_link(
-    html_template: str,
-    contact_id: str,
-    target_base_url: str,
+DEFAULT_CAMPAIGN_TEMPLATE = """
+<html>
+    <body>
+        <div style="font-size: 14px;">
+            <p>
+                Bonjour bonjour,<br><br>
+                Merci d’avoir rejoint Tinymail.<br><br>
+                L’équipe Tinymail.
+            </p>
+        </div>
+    </body>
+</html>
+"""
+
+
+# replaced by the per-recipient urls after rendering, made of characters
+# that neither lxml (url attributes escaping) nor jinja touch
+UNSUBSCRIBE_URL_PLACEHOLDER = "TINYMAIL_UNSUBSCRIBE_URL"
+PIXEL_URL_PLACEHOLDER = "TINYMAIL_PIXEL_URL"
+
+jinja_env = Environment()
+
+
+def unsubscribe_link_element(
+    unsubscribe_url: str,
     message_before: str = "You don't want to hearing from us ? ",
     message: str = "Unsubscribe",
-) -> str:
-    token = generate_confirmation_token(contact_id)
-    unsubscribe_url = target_base_url + f"/{token}"
+):
     unsubscribe_link = f"""
     <div class="footer" style="clear: both; margin-top: 30px; width: 100%; font-size: 10px;">
         <br> {message_before} <a href={unsubscribe_url} style="text-decoration: underline; color: #999999; text-align: center;">{message}</a>.
     </div>"""
-    element = html.fromstring(unsubscribe_link)
-    html_template_tree = html.fromstring(html_template)
-    html_template_tree.body.append(element)
-    return html.tostring(html_template_tree).decode("utf-8")
+    return html.fromstring(unsubscribe_link)
 
 
-def add_pixel_link(html_template: str, email_id: str, target_base_url: str) -> str:
-    token = generate_confirmation_token(email_id)
-    image_url = target_base_url + f"/{token}"
+def pixel_link_element(image_url: str):
     pixel_link = f"""<img src={image_url} style="height: 1px !important; max-height: 1px !important; max-width: 1px !important; width: 1px !important"/>"""
-    element = html.fromstring(pixel_link)
-    html_template_tree = html.fromstring(html_template)
-    html_template_tree.body.append(element)
+    return html.fromstring(pixel_link)
+
+
+def add_tracking_links(
+    html_template: str, unsubscribe_url: str = None, pixel_url: str = None
+) -> str:
+    # a fragment or plain text is wrapped in a body to hold the links
+    html_template_tree = html.document_fromstring(html_template)
+    if unsubscribe_url:
+        html_template_tree.body.append(unsubscribe_link_element(unsubscribe_url))
+    if pixel_url:
+        html_template_tree.body.append(pixel_link_element(pixel_url))
     return html.tostring(html_template_tree).decode("utf-8")
 
 
-def send_email(
+class CompiledTemplate(object):
+    """A mail template parsed and compiled once, tracking links included as
+    placeholders, so that sending it only takes a jinja render."""
+
+    def __init__(
+        self,
+        html_template: str,
+        subject: str,
+        unsubscribe_link: bool = False,
+        pixel_link: bool = False,
+    ):
+        if unsubscribe_link or pixel_link:
+            html_template = add_tracking_links(
+                html_template,
+                unsubscribe_url=UNSUBSCRIBE_URL_PLACEHOLDER if unsubscribe_link else None,
+                pixel_url=PIXEL_URL_PLACEHOLDER if pixel_link else None,
+            )
+        self.html = jinja_env.from_string(html_template)
+        self.subject = jinja_env.from_string(subject or "")
+
+    def render(
+        self,
+        infos_to_render: dict,
+        unsubscribe_url: Optional[str] = None,
+        pixel_url: Optional[str] = None,
+    ) -> Tuple[str, str]:
+        rendered = self.html.render(**infos_to_render)
+        if unsubscribe_url:
+            rendered = rendered.replace(UNSUBSCRIBE_URL_PLACEHOLDER, unsubscribe_url)
+        if pixel_url:
+            rendered = rendered.replace(PIXEL_URL_PLACEHOLDER, pixel_url)
+        return self.subject.render(**infos_to_render), rendered
+
+
+class TemplateCache(object):
+    """LRU of compiled templates keyed by the hash of their source."""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0
+
+    def get(
+        self,
+        html_template: str,
+        subject: str,
+        unsubscribe_link: bool = False,
+        pixel_link: bool = False,
+    ) -> CompiledTemplate:
+        key = hashlib.sha1(
+            repr((html_template, subject, unsubscribe_link, pixel_link)).encode("utf-8")
+        ).hexdigest()
+
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.stats["hits"] += 1
+                return template
+            self.stats["misses"] += 1
+
+        template = CompiledTemplate(
+            html_template, subject, unsubscribe_link=unsubscribe_link, pixel_link=pixel_link
+        )
+
+        with self._lock:
+            self._templates[key] = template
+            if len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+                self.stats["evictions"] += 1
+        return template
+
+
+template_cache = TemplateCache(maxsize=settings.TEMPLATE_CACHE_SIZE)
+
+
+def check_template(html_template: Optional[str], subject: Optional[str]) -> Optional[str]:
+    """Returns why a campaign's template cannot be compiled, if it cannot,
+    so that it is rejected before any mail is claimed."""
+    try:
+        CompiledTemplate(
+            html_template or DEFAULT_CAMPAIGN_TEMPLATE,
+            subject or "",
+            unsubscribe_link=True,
+            pixel_link=True,
+        )
+    except (TemplateSyntaxError, etree.ParserError) as e:
+        return str(e)
+    return None
+
+
+def build_email(
     email_to: str,
+    mail_from: str,
     name_from: str,
     html_template: str,
     subject: str,
@@ -45,36 +173,50 @@ def send_email(
     contact_id: int = None,
     pixel_link: bool = False,
     email_id: int = None,
-):
+    unsubscribe_token: str = None,
+) -> str:
+    template = template_cache.get(
+        html_template, subject, unsubscribe_link=unsubscribe_link, pixel_link=pixel_link
+    )
 
+    unsubscribe_url = pixel_url = None
     if unsubscribe_link:
-        html_template = add_unsubscribe_link(
-            html_template,
-            contact_id=contact_id,
-            target_base_url=settings.UNSUBSCRIBE_URL,
-        )
-
+        token = unsubscribe_token or generate_confirmation_token(contact_id)
+        unsubscribe_url = settings.UNSUBSCRIBE_URL + f"/{token}"
     if pixel_link:
-        html_template = add_pixel_link(
-            html_template, email_id=email_id, target_base_url=settings.PIXEL_URL
-        )
+        token = generate_confirmation_token(email_id)
+        pixel_url = settings.PIXEL_URL + f"/{token}"
+
+    subject, html_content = template.render(
+        infos_to_render, unsubscribe_url=unsubscribe_url, pixel_url=pixel_url
+    )
 
     message = emails.html(
-        subject=T(subject),
-        html=T(html_template),
-        mail_from=(name_from, settings.MAIL_ADDRESS),
+        subject=subject,
+        html=html_content,
+        mail_from=(name_from, mail_from),
     )
+    message.set_mail_to(email_to)
+    return message.as_string()
+
+
+def submit_email(email_to: str, account: SenderAccount, **kwargs) -> Future:
+    """Renders a mail and hands it to the SMTP delivery of the sender
+    account: the asyncio engine when SMTP_ASYNC is set, the future being done
+    once the mail is sent, otherwise the account's connection pool, the mail
+    being sent before returning."""
+    msg = build_email(email_to=email_to, mail_from=account.address, **kwargs)
+    if settings.SMTP_ASYNC:
+        return get_delivery_engine().submit(account.address, [email_to], msg)
 
-    r = message.send(
-        to=email_to,
-        render=infos_to_render,
-        smtp={
-            "host": settings.SMTP_HOST,
-            "port": settings.SMTP_PORT,
-            "ssl": settings.SMTP_SSL,
-            "user": settings.MAIL_ADDRESS,
-            "password": settings.MAIL_PWD,
-        },
+    future = Future()
+    future.set_result(
+        get_smtp_pool(account).sendmail(
+            from_addr=account.address, to_addrs=[email_to], msg=msg
+        )
     )
+    return future
+
 
-    return r
+def send_email(email_to: str, account: SenderAccount, **kwargs) -> SMTPResult:
+    return submit_email(email_to=email_to, account=account, **kwargs).result()
@@ -1,7 +1,9 @@
 from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
 
 from app.api import api_router
 
 
 app = FastAPI(title="Tinymail API")
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 app.include_router(api_router, prefix="/api")
@@ -1,6 +1,21 @@
 from datetime import datetime, timezone, timedelta
-from sqlmodel import Field, SQLModel, Column, JSON, Relationship, Session, select
-from typing import Optional, Dict, List
+from enum import Enum
+from sqlalchemy import Index, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.types import TypeDecorator
+from sqlmodel import (
+    Field,
+    SQLModel,
+    Column,
+    JSON,
+    Relationship,
+    Session,
+    case,
+    func,
+    select,
+    update,
+)
+from typing import Any, Dict, List, Literal, Optional
 
 
 ############ Contact & Campaign Link ############
@@ -11,16 +26,29 @@ class ContactCampaignLink(SQLModel, table=True):
         default=None, foreign_key="campaign.id", primary_key=True
     )
     contact_id: Optional[int] = Field(
-        default=None, foreign_key="contact.id", primary_key=True
+        default=None, foreign_key="contact.id", primary_key=True, index=True
     )
 
 
 ############ Contact ############
 
 
+class MetaJSON(TypeDecorator):
+    """JSON column stored as JSONB on postgresql, for segments to use its
+    GIN index (`with_variant` does not survive pydantic's field deepcopy)."""
+
+    impl = JSON
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(JSONB())
+        return dialect.type_descriptor(JSON())
+
+
 class ContactBase(SQLModel):
     email: str
-    meta: Dict = Field(default={}, sa_column=Column(JSON))
+    meta: Dict = Field(default={}, sa_column=Column(MetaJSON))
     status: str = "non-subscribed"
 
     class Config:
@@ -29,6 +57,7 @@ class ContactBase(SQLModel):
 
 class Contact(ContactBase, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
+    email: str = Field(index=True, sa_column_kwargs={"unique": True})
 
     campaigns: List["Campaign"] = Relationship(
         back_populates="contacts", link_model=ContactCampaignLink
@@ -68,27 +97,101 @@ class Campaign(CampaignBase, table=True):
         back_populates="campaigns", link_model=ContactCampaignLink
     )
     mails: List["Mail"] = Relationship(back_populates="campaign")
+    stats: Optional["CampaignStats"] = Relationship(
+        sa_relationship_kwargs={"uselist": False, "cascade": "all, delete-orphan"}
+    )
 
-    def open_rate(self) -> float:
-        return sum([mail.is_open for mail in self.mails]) / len(self.mails)
+    class Config:
+        arbitrary_types_allowed = True
 
-    def send_rate(self) -> float:
-        return sum([mail.time_send is not None for mail in self.mails]) / len(
-            self.mails
+    @classmethod
+    def contact_count_column(cls):
+        # correlated count, served by the link table's primary key
+        return (
+            select(func.count(ContactCampaignLink.contact_id))
+            .where(ContactCampaignLink.campaign_id == cls.id)
+            .scalar_subquery()
+            .label("contact_count")
         )
 
-    class Config:
-        arbitrary_types_allowed = True
+
+class CampaignStats(SQLModel, table=True):
+    # counters maintained incrementally by the worker and the webhooks
+    campaign_id: Optional[int] = Field(
+        default=None, foreign_key="campaign.id", primary_key=True
+    )
+    mails: int = 0
+    sent: int = 0
+    opened: int = 0
+    failed: int = 0
+    unsubscribed: int = 0
+
+    @classmethod
+    def incr(cls, session: Session, campaign_id: int, **counts: int):
+        counts = {k: v for k, v in counts.items() if v}
+        if not campaign_id or not counts:
+            return
+        values = {k: getattr(cls, k) + v for k, v in counts.items()}
+        result = session.execute(
+            update(cls).where(cls.campaign_id == campaign_id).values(**values)
+        )
+        if not result.rowcount:
+            session.add(cls(campaign_id=campaign_id, **counts))
+
+    @classmethod
+    def incr_for_contact(cls, contact_id: int, **counts: int):
+        # counts an event once for every campaign the contact belongs to
+        values = {k: getattr(cls, k) + v for k, v in counts.items()}
+        return (
+            update(cls)
+            .where(
+                cls.campaign_id.in_(
+                    select(ContactCampaignLink.campaign_id).where(
+                        ContactCampaignLink.contact_id == contact_id
+                    )
+                )
+            )
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
+
+class CampaignStatsRead(SQLModel):
+    mails: int = 0
+    sent: int = 0
+    opened: int = 0
+    failed: int = 0
+    unsubscribed: int = 0
+    open_rate: float = 0
+    send_rate: float = 0
+
+    @classmethod
+    def from_counts(cls, **counts: int) -> "CampaignStatsRead":
+        mails = counts.get("mails") or 0
+        return cls(
+            **counts,
+            open_rate=counts.get("opened", 0) / mails if mails else 0,
+            send_rate=counts.get("sent", 0) / mails if mails else 0,
+        )
 
 
 class CampaignCreate(CampaignBase):
     contacts_ids_to_add: List[int] = []
 
 
-class CampaignRead(CampaignBase):
+class CampaignReadBase(CampaignBase):
     id: int
 
 
+class CampaignRead(CampaignReadBase):
+    contact_count: int = 0
+
+
+class CampaignReadWithChanges(CampaignRead):
+    contacts_added: int = 0
+    contacts_removed: int = 0
+
+
 class CampaignUpdate(SQLModel):
     name: Optional[str] = None
     contacts_ids_to_add: List[int] = []
@@ -98,6 +201,76 @@ class CampaignUpdate(SQLModel):
     subject: Optional[str] = None
 
 
+############ Segments ############
+
+
+class SegmentPredicate(SQLModel):
+    # "status", "campaign" (id of a campaign the contact belongs to) or "meta.<key>"
+    field: str
+    op: Literal[
+        "eq", "ne", "in", "not_in", "gt", "gte", "lt", "lte", "contains", "exists"
+    ] = "eq"
+    value: Any = None
+
+
+class SegmentDefinition(SQLModel):
+    match: Literal["all", "any"] = "all"
+    predicates: List[SegmentPredicate] = []
+
+
+class SegmentBase(SQLModel):
+    name: str
+
+
+class Segment(SegmentBase, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    definition: Dict = Field(default={}, sa_column=Column(JSON))
+
+    class Config:
+        arbitrary_types_allowed = True
+
+
+class SegmentCreate(SegmentBase):
+    definition: SegmentDefinition = SegmentDefinition()
+
+
+class SegmentRead(SegmentBase):
+    id: int
+    definition: SegmentDefinition
+
+
+############ Suppressions ############
+
+
+class SuppressionReason(str, Enum):
+    unsubscribed = "unsubscribed"
+    bounced = "bounced"
+    complained = "complained"
+    manual = "manual"
+
+
+class SuppressionBase(SQLModel):
+    # lowercased, see app.suppression
+    email: str
+    reason: SuppressionReason = SuppressionReason.manual
+
+
+class Suppression(SuppressionBase, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    email: str = Field(index=True, sa_column_kwargs={"unique": True})
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class SuppressionRead(SuppressionBase):
+    id: int
+    created_at: datetime
+
+
+class SuppressionImport(SQLModel):
+    emails: List[str]
+    reason: SuppressionReason = SuppressionReason.manual
+
+
 ############ Mail Templates ############
 
 
@@ -126,6 +299,21 @@ class MailTemplateUpdate(SQLModel):
 ############ Mails ############
 
 
+class MailStatus(str, Enum):
+    # queued -> sending -> sent / failed / suppressed, or back to deferred -> sending
+    queued = "queued"
+    sending = "sending"
+    sent = "sent"
+    failed = "failed"
+    deferred = "deferred"
+    # dropped before sending, the address being on the suppression list
+    suppressed = "suppressed"
+
+
+# a worker only takes the mails nobody is sending or has sent
+CLAIMABLE_MAIL_STATUSES = (MailStatus.queued, MailStatus.deferred)
+
+
 class MailBase(SQLModel):
     # time_send: Optional[datetime] = Field(sa_column=Column(DateTime(timezone=True), nullable=False, default=datetime.now(timezone.utc)))
     time_send: Optional[datetime] = None
@@ -133,35 +321,83 @@ class MailBase(SQLModel):
 
 
 class Mail(MailBase, table=True):
+    __table_args__ = (
+        Index(
+            "ix_mail_unsent",
+            "campaign_id",
+            postgresql_where=text("time_send IS NULL"),
+            sqlite_where=text("time_send IS NULL"),
+        ),
+        # only the mails still waiting for the dispatcher are indexed
+        Index(
+            "ix_mail_scheduled_at",
+            "scheduled_at",
+            postgresql_where=text("scheduled_at IS NOT NULL"),
+            sqlite_where=text("scheduled_at IS NOT NULL"),
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
+    time_send: Optional[datetime] = Field(default=None, index=True)
+    # set until the dispatcher enqueues the mail
+    scheduled_at: Optional[datetime] = None
+    status: MailStatus = MailStatus.queued
+    # temporary failures (4xx) so far, see app.throttle
+    attempts: int = 0
+    # when the mail was last moved to `sending`, see CRUDMail.reap
+    claimed_at: Optional[datetime] = None
+    # one row per intended delivery, e.g. "campaign-<id>-<contact id>"
+    idempotency_key: Optional[str] = Field(
+        default=None, index=True, sa_column_kwargs={"unique": True}
+    )
+
+    # content of the mails sent outside of a campaign
+    subject: Optional[str] = None
+    sender_name: Optional[str] = None
+    html_template: Optional[str] = None
 
-    contact_id: Optional[int] = Field(default=None, foreign_key="contact.id")
+    contact_id: Optional[int] = Field(
+        default=None, foreign_key="contact.id", index=True
+    )
     contact: Optional[Contact] = Relationship(back_populates="mails")
 
-    campaign_id: Optional[int] = Field(default=None, foreign_key="campaign.id")
+    campaign_id: Optional[int] = Field(
+        default=None, foreign_key="campaign.id", index=True
+    )
     campaign: Optional[Campaign] = Relationship(back_populates="mails")
 
+    @classmethod
+    def campaign_key(cls, campaign_id: int, contact_id: int) -> str:
+        return f"campaign-{campaign_id}-{contact_id}"
+
     @classmethod
     def month_count(cls, session: Session):
         # rolling average number of mails send in a month
-        return len(
-            session.exec(
-                select(cls).where(
-                    cls.time_send >= (datetime.now(timezone.utc) - timedelta(days=30))
-                )
-            ).all()
-        )
+        return session.exec(
+            select(func.count(cls.id)).where(
+                cls.time_send >= (datetime.now(timezone.utc) - timedelta(days=30))
+            )
+        ).one()
+
+    @classmethod
+    def campaign_stats(cls, campaign_id: int):
+        # counters of a campaign in one aggregate query
+        sent = case((cls.time_send != None, 1), else_=0)
+        opened = case((cls.is_open == True, 1), else_=0)
+        return select(
+            func.count(cls.id).label("mails"),
+            func.coalesce(func.sum(sent), 0).label("sent"),
+            func.coalesce(func.sum(opened), 0).label("opened"),
+        ).where(cls.campaign_id == campaign_id)
 
     @classmethod
     def day_count(cls, session: Session):
         # rolling average number of mails send in 24 hours
-        return len(
-            session.exec(
-                select(cls).where(
-                    cls.time_send >= (datetime.now(timezone.utc) - timedelta(hours=24))
-                )
-            ).all()
-        )
+        return session.exec(
+            select(func.count(cls.id)).where(
+                cls.time_send >= (datetime.now(timezone.utc) - timedelta(hours=24))
+            )
+        ).one()
 
 
 class MailCreate(MailBase):
@@ -171,12 +407,20 @@ class MailCreate(MailBase):
     campaign_id: Optional[int]
     time_to_send: Optional[datetime]
     html_template: Optional[str] = ""
+    # sending twice with the same key only creates (and sends) one mail
+    idempotency_key: Optional[str] = None
 
 
 class MailRead(MailBase):
     id: int
     contact_id: Optional[int]
     campaign_id: Optional[int]
+    scheduled_at: Optional[datetime]
+    status: MailStatus
+
+
+class MailSchedule(SQLModel):
+    scheduled_at: datetime
 
 
 class MailUpdate(SQLModel):
@@ -187,12 +431,9 @@ class MailUpdate(SQLModel):
 ############ Join Contact & Campaign ############
 
 
-class CampaignReadWithContacts(CampaignRead):
-    contacts: List[ContactRead] = []
-
-
 class ContactReadWithCampaigns(ContactRead):
-    campaigns: List[CampaignRead] = []
+    # without their contact_count, not computed for the nested campaigns
+    campaigns: List[CampaignReadBase] = []
 
 
 class MailReadWithContact(MailRead):
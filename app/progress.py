@@ -0,0 +1,51 @@
+from typing import Dict, Optional
+
+from app.cache import redis_client
+
+
+PROGRESS_COUNTERS = ("total", "enqueued", "sent", "failed", "deferred", "suppressed")
+# mails sent by each sender account, as "sent:<address>" counters
+ACCOUNT_COUNTER_PREFIX = "sent:"
+
+
+def progress_key(campaign_id: int) -> str:
+    return f"campaign:{campaign_id}:progress"
+
+
+def init_progress(campaign_id: int, job_id: str):
+    key = progress_key(campaign_id)
+    pipe = redis_client.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={"job_id": job_id, **{c: 0 for c in PROGRESS_COUNTERS}})
+    pipe.execute()
+
+
+def incr_progress(campaign_id: int, **counts: int):
+    key = progress_key(campaign_id)
+    pipe = redis_client.pipeline()
+    for counter, value in counts.items():
+        if value:
+            pipe.hincrby(key, counter, value)
+    pipe.execute()
+
+
+def account_counts(sent_by_account: Dict[str, int]) -> Dict[str, int]:
+    """Counters of `incr_progress` for the mails sent by each account."""
+    return {
+        ACCOUNT_COUNTER_PREFIX + address: n for address, n in sent_by_account.items()
+    }
+
+
+def get_progress(campaign_id: int) -> Optional[Dict]:
+    progress = redis_client.hgetall(progress_key(campaign_id))
+    if not progress:
+        return None
+    return {
+        "job_id": progress.get("job_id"),
+        **{c: int(progress.get(c, 0)) for c in PROGRESS_COUNTERS},
+        "sent_by_account": {
+            field[len(ACCOUNT_COUNTER_PREFIX):]: int(value)
+            for field, value in progress.items()
+            if field.startswith(ACCOUNT_COUNTER_PREFIX)
+        },
+    }
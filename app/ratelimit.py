@@ -0,0 +1,107 @@
+import time
+import uuid
+from typing import List, Tuple
+
+from redis import Redis
+
+
+# Sliding window log: one sorted set per (account, window), scored by the
+# send time in milliseconds. All windows are checked and filled in a single
+# script so the limits hold across every worker sharing the Redis instance.
+SLIDING_WINDOW_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local n = tonumber(ARGV[1])
+local retry_after = 0
+
+for i, key in ipairs(KEYS) do
+    local window = tonumber(ARGV[1 + i * 2])
+    local limit = tonumber(ARGV[2 + i * 2])
+    if n > limit then
+        return -1
+    end
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    local count = redis.call('ZCARD', key)
+    if count + n > limit then
+        local oldest = redis.call('ZRANGE', key, count + n - limit - 1, count + n - limit - 1, 'WITHSCORES')
+        local wait = tonumber(oldest[2]) + window - now
+        if wait > retry_after then
+            retry_after = wait
+        end
+    end
+end
+
+if retry_after > 0 then
+    return retry_after
+end
+
+for i, key in ipairs(KEYS) do
+    local window = tonumber(ARGV[1 + i * 2])
+    for j = 1, n do
+        redis.call('ZADD', key, now, ARGV[2] .. ':' .. j)
+    end
+    redis.call('PEXPIRE', key, window)
+end
+return 0
+"""
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RateLimiter(object):
+    """Distributed sliding-window rate limiter.
+
+    `limits` is a list of (window in seconds, max sends in the window) pairs,
+    all of them being enforced at once for a given account.
+    """
+
+    def __init__(self, client: Redis, limits: List[Tuple[int, int]], prefix: str = "ratelimit"):
+        self.client = client
+        self.limits = limits
+        self.prefix = prefix
+        self._script = client.register_script(SLIDING_WINDOW_SCRIPT)
+
+    def _keys(self, account: str, limits: List[Tuple[int, int]]) -> List[str]:
+        return [f"{self.prefix}:{account}:{window}" for window, _ in limits]
+
+    def acquire(
+        self, account: str, n: int = 1, limits: List[Tuple[int, int]] = None
+    ) -> float:
+        """Takes `n` sends from the account's budget.
+
+        Returns 0 when granted, otherwise the number of seconds to wait
+        before the budget allows it (nothing is taken in that case).
+        `limits` overrides the limiter's ones, for budgets changing over time.
+        """
+        limits = self.limits if limits is None else limits
+        if not limits:
+            return 0
+
+        args = [n, uuid.uuid4().hex]
+        for window, limit in limits:
+            args += [window * 1000, limit]
+
+        retry_after = self._script(keys=self._keys(account, limits), args=args)
+        if retry_after < 0:
+            raise RateLimitExceeded(f"Cannot send {n} mails at once for {account}")
+        return retry_after / 1000
+
+    def usage(self, accounts: List[str], window: int) -> List[int]:
+        """Sends of each account over the last `window` seconds, in one
+        round-trip."""
+        since = (time.time() - window) * 1000
+        pipe = self.client.pipeline()
+        for account in accounts:
+            pipe.zcount(f"{self.prefix}:{account}:{window}", f"({since}", "+inf")
+        return pipe.execute()
+
+    def wait(self, account: str, max_sleep: float, n: int = 1) -> float:
+        """Like `acquire`, but sleeps through short waits to pace sends
+        smoothly. Returns 0 once granted, or the wait if it exceeds `max_sleep`."""
+        retry_after = self.acquire(account, n=n)
+        while 0 < retry_after <= max_sleep:
+            time.sleep(retry_after)
+            retry_after = self.acquire(account, n=n)
+        return retry_after
@@ -0,0 +1,136 @@
+import json
+from sqlalchemy import and_, case, cast, false, func, not_, or_, true
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlmodel import select
+
+from app.models import Contact, ContactCampaignLink, SegmentDefinition, SegmentPredicate
+
+
+class InvalidPredicate(ValueError):
+    pass
+
+
+SCALAR_TYPES = (str, int, float, bool)
+
+
+def check_value(op: str, value, types: tuple = SCALAR_TYPES, nullable: bool = True):
+    """Rejects the values the operator cannot be compiled with."""
+    if op in ("in", "not_in"):
+        valid = isinstance(value, list) and all(isinstance(v, types) for v in value)
+        expected = "a list of values"
+    elif op == "contains":
+        valid = isinstance(value, str)
+        expected = "a string"
+    elif op in ("eq", "ne"):
+        valid = isinstance(value, types) or (nullable and value is None)
+        expected = "a value"
+    else:
+        valid = isinstance(value, types)
+        expected = "a value"
+    if not valid:
+        raise InvalidPredicate(f"Operator {op} expects {expected}, got {value!r}")
+
+
+def compare(column, op: str, value):
+    check_value(op, value)
+    if op == "eq":
+        return column == value
+    if op == "ne":
+        return column != value
+    if op == "in":
+        return column.in_(value)
+    if op == "not_in":
+        return column.not_in(value)
+    if op == "gt":
+        return column > value
+    if op == "gte":
+        return column >= value
+    if op == "lt":
+        return column < value
+    if op == "lte":
+        return column <= value
+    if op == "contains":
+        return column.contains(value)
+    raise InvalidPredicate(f"Operator {op} is not supported here")
+
+
+# JSON types of the values compared, as named by postgresql (jsonb_typeof)
+# and sqlite (json_type)
+JSON_TYPES = {
+    bool: ("boolean", ("true", "false")),
+    float: ("number", ("integer", "real")),
+    str: ("string", ("text",)),
+}
+
+
+def json_type_is(key: str, python_type: type, dialect: str):
+    """Whether the meta value is of the JSON type of `python_type`, meta being
+    free-form: the other values are left out of comparisons instead of being
+    cast, which postgresql would fail on and sqlite would coerce."""
+    pg_type, sqlite_types = JSON_TYPES[python_type]
+    if dialect == "postgresql":
+        return func.jsonb_typeof(Contact.meta[key]) == pg_type
+    return func.json_type(Contact.meta, f'$."{key}"').in_(sqlite_types)
+
+
+def meta_clause(key: str, predicate: SegmentPredicate, dialect: str):
+    op, value = predicate.op, predicate.value
+    element = Contact.meta[key]
+
+    if op == "exists":
+        if dialect == "postgresql":
+            exists = Contact.meta.op("?")(key)
+        else:
+            exists = element.as_string().isnot(None)
+        return exists if value is not False else not_(exists)
+
+    check_value(op, value)
+    # containment is served by the GIN index on meta
+    if op == "eq" and dialect == "postgresql":
+        return Contact.meta.op("@>")(cast(json.dumps({key: value}), JSONB))
+
+    sample = value[0] if isinstance(value, list) and value else value
+    if isinstance(sample, bool):
+        python_type, element = bool, element.as_boolean()
+    elif isinstance(sample, (int, float)):
+        python_type, element = float, element.as_float()
+    else:
+        python_type, element = str, element.as_string()
+    # NULL unless of the right type, the CASE checking the type before casting
+    element = case((json_type_is(key, python_type, dialect), element))
+    return compare(element, op, value)
+
+
+def campaign_clause(predicate: SegmentPredicate):
+    op, value = predicate.op, predicate.value
+    members = select(ContactCampaignLink.contact_id)
+    if op in ("eq", "ne", "in", "not_in"):
+        check_value(op, value, types=(int,), nullable=False)
+    if op in ("eq", "ne"):
+        members = members.where(ContactCampaignLink.campaign_id == value)
+    elif op in ("in", "not_in"):
+        members = members.where(ContactCampaignLink.campaign_id.in_(value))
+    else:
+        raise InvalidPredicate(f"Operator {op} is not supported on campaigns")
+
+    if op in ("eq", "in"):
+        return Contact.id.in_(members)
+    return Contact.id.not_in(members)
+
+
+def predicate_clause(predicate: SegmentPredicate, dialect: str):
+    if predicate.field == "status":
+        return compare(Contact.status, predicate.op, predicate.value)
+    if predicate.field == "campaign":
+        return campaign_clause(predicate)
+    if predicate.field.startswith("meta."):
+        return meta_clause(predicate.field[len("meta."):], predicate, dialect)
+    raise InvalidPredicate(f"Unknown field {predicate.field}")
+
+
+def segment_clause(definition: SegmentDefinition, dialect: str):
+    """Compiles a segment definition to a WHERE clause on contact."""
+    clauses = [predicate_clause(p, dialect) for p in definition.predicates]
+    if definition.match == "any":
+        return or_(false(), *clauses)
+    return and_(true(), *clauses)
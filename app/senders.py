@@ -0,0 +1,81 @@
+import time
+from math import floor
+from typing import Dict, List, Optional, Tuple
+
+from redis import Redis
+
+from app.cache import redis_client
+from app.ratelimit import RateLimiter
+from settings import SenderAccount, settings
+
+
+DAY = 24 * 60 * 60
+
+
+def account_limits(account: SenderAccount, share: float = 1) -> List[Tuple[int, int]]:
+    """The account's limits, or `share` of them: the windows being counted
+    for all the mails, the rest of the budget is kept for the other sends."""
+    limits = [(DAY, account.daily_limit)]
+    if account.rate_limit_per_minute:
+        limits.append((60, account.rate_limit_per_minute))
+    if account.rate_limit_per_second:
+        limits.append((1, account.rate_limit_per_second))
+    return [(window, max(floor(limit * share), 1)) for window, limit in limits]
+
+
+class SenderPool(object):
+    """Spreads the mails over the sender accounts, each with its own limits
+    (shared by all the workers through redis): a mail goes to the least
+    loaded account, by share of its daily quota used, that can send now."""
+
+    def __init__(self, client: Redis, accounts: List[SenderAccount]):
+        self.accounts = accounts
+        self.limiter = RateLimiter(client, limits=[])
+
+    def loads(self) -> Dict[str, int]:
+        """Mails sent by each account over the last day."""
+        addresses = [account.address for account in self.accounts]
+        return dict(zip(addresses, self.limiter.usage(addresses, DAY)))
+
+    def acquire(self, share: float = 1) -> Tuple[Optional[SenderAccount], float]:
+        """Takes a send from the least loaded account able to send now,
+        within `share` of its limits. Returns the account, or None and the
+        seconds to wait if none is."""
+        loads = self.loads()
+        accounts = sorted(self.accounts, key=lambda a: loads[a.address] / a.daily_limit)
+
+        # the accounts over quota are tried last, telling how long to wait
+        retry_after = DAY
+        for account in accounts:
+            limits = account_limits(account, share)
+            wait = self.limiter.acquire(account.address, limits=limits)
+            if not wait:
+                return account, 0
+            retry_after = min(retry_after, wait)
+        return None, retry_after
+
+    def wait(
+        self, max_sleep: float, share: float = 1
+    ) -> Tuple[Optional[SenderAccount], float]:
+        """Like `acquire`, but sleeps through short waits to pace sends
+        smoothly, see `RateLimiter.wait`."""
+        account, retry_after = self.acquire(share)
+        while 0 < retry_after <= max_sleep:
+            time.sleep(retry_after)
+            account, retry_after = self.acquire(share)
+        return account, retry_after
+
+    def capacity(self) -> List[dict]:
+        loads = self.loads()
+        return [
+            {
+                "address": account.address,
+                "daily_limit": account.daily_limit,
+                "sent_today": loads[account.address],
+                "remaining": max(account.daily_limit - loads[account.address], 0),
+            }
+            for account in self.accounts
+        ]
+
+
+sender_pool = SenderPool(redis_client, settings.SENDER_ACCOUNTS)
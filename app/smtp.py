@@ -0,0 +1,189 @@
+import os
+import smtplib
+import threading
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from settings import SenderAccount, settings
+
+
+class SMTPResult(object):
+    """Outcome of a single SMTP transaction, mirroring the `status_code`
+    attribute of the responses returned by the `emails` backend."""
+
+    def __init__(self, status_code: Optional[int], status_text: str = "", error=None):
+        self.status_code = status_code
+        self.status_text = status_text
+        self.error = error
+
+    def __repr__(self):
+        return f"<SMTPResult {self.status_code} {self.status_text!r}>"
+
+
+class PooledConnection(object):
+    def __init__(self, client: smtplib.SMTP):
+        self.client = client
+        self.created_at = time.monotonic()
+        self.messages = 0
+
+    def close(self):
+        try:
+            self.client.quit()
+        except (smtplib.SMTPException, OSError):
+            self.client.close()
+
+
+class SMTPConnectionPool(object):
+    """Keeps authenticated SMTP connections alive across tasks.
+
+    Connections are recycled after `max_messages` messages or once they are
+    older than `max_age` seconds, and transparently reopened when the server
+    drops them.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        ssl: bool,
+        user: str,
+        password: str,
+        max_size: int = 2,
+        max_messages: int = 100,
+        max_age: int = 300,
+        timeout: int = 30,
+    ):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.user = user
+        self.password = password
+        self.max_size = max_size
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.timeout = timeout
+
+        self._idle: List[PooledConnection] = []
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "reconnects": 0, "recycled": 0}
+
+    def _connect(self) -> PooledConnection:
+        if self.ssl:
+            client = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            client = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.user and self.password:
+            client.login(self.user, self.password)
+        return PooledConnection(client)
+
+    def _expired(self, conn: PooledConnection) -> bool:
+        return (
+            conn.messages >= self.max_messages
+            or time.monotonic() - conn.created_at >= self.max_age
+        )
+
+    def acquire(self) -> PooledConnection:
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if not self._expired(conn):
+                    self.stats["hits"] += 1
+                    return conn
+                self.stats["recycled"] += 1
+                conn.close()
+            self.stats["misses"] += 1
+        return self._connect()
+
+    def release(self, conn: PooledConnection, discard: bool = False):
+        if discard or self._expired(conn):
+            if not discard:
+                self.stats["recycled"] += 1
+            conn.close()
+            return
+
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _sendmail(self, conn: PooledConnection, from_addr: str, to_addrs, msg: str):
+        refused = conn.client.sendmail(from_addr, to_addrs, msg)
+        conn.messages += 1
+        if refused:
+            code, text = next(iter(refused.values()))
+            return SMTPResult(code, text.decode("utf-8", "replace"))
+        return SMTPResult(250, "OK")
+
+    def sendmail(self, from_addr: str, to_addrs, msg: str) -> SMTPResult:
+        try:
+            conn = self.acquire()
+        except (smtplib.SMTPException, OSError) as e:
+            logger.warning(f"Cannot connect to {self.host}: {e}")
+            return SMTPResult(None, str(e), error=e)
+
+        try:
+            try:
+                result = self._sendmail(conn, from_addr, to_addrs, msg)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # stale connection (idle timeout on the server side), retry once
+                conn.close()
+                self.stats["reconnects"] += 1
+                conn = self._connect()
+                result = self._sendmail(conn, from_addr, to_addrs, msg)
+        except smtplib.SMTPRecipientsRefused as e:
+            self.release(conn)
+            code, text = next(iter(e.recipients.values()))
+            return SMTPResult(code, text.decode("utf-8", "replace"), error=e)
+        except smtplib.SMTPResponseException as e:
+            self.release(conn, discard=e.smtp_code == 421)
+            return SMTPResult(e.smtp_code, e.smtp_error.decode("utf-8", "replace"), error=e)
+        except (smtplib.SMTPException, OSError) as e:
+            self.release(conn, discard=True)
+            logger.warning(f"SMTP error on {self.host}: {e}")
+            return SMTPResult(None, str(e), error=e)
+
+        self.release(conn)
+        return result
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pools: Dict[str, SMTPConnectionPool] = {}
+_pools_pid: Optional[int] = None
+
+
+def get_smtp_pool(account: SenderAccount) -> SMTPConnectionPool:
+    """Returns the SMTP pool of the sender account in the current process.
+
+    Celery prefork workers inherit module state from the parent, so the pools
+    are rebuilt whenever the pid changes to avoid sharing sockets across forks.
+    """
+    global _pools, _pools_pid
+
+    if _pools_pid != os.getpid():
+        _pools, _pools_pid = {}, os.getpid()
+    if account.address not in _pools:
+        _pools[account.address] = SMTPConnectionPool(
+            host=account.smtp_host,
+            port=account.smtp_port,
+            ssl=account.smtp_ssl,
+            user=account.address,
+            password=account.password,
+            max_size=settings.SMTP_POOL_SIZE,
+            max_messages=settings.SMTP_POOL_MAX_MESSAGES,
+            max_age=settings.SMTP_POOL_MAX_AGE,
+            timeout=settings.SMTP_TIMEOUT,
+        )
+    return _pools[account.address]
+
+
+def get_smtp_pools() -> Dict[str, SMTPConnectionPool]:
+    """The pools opened by the current process, by sender address."""
+    return _pools if _pools_pid == os.getpid() else {}
@@ -0,0 +1,144 @@
+import uuid
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Set
+
+from loguru import logger
+from sqlmodel import Session, delete, select
+
+from app.cache import redis_client
+from app.db import upsert
+from app.models import Suppression, SuppressionReason
+from app.utils import chunked
+from settings import settings
+
+
+# mirror of the suppression table, checked before every send
+SUPPRESSED_EMAILS_KEY = "suppressions:emails"
+# always a member, so that a mirror lost (redis flushed or restarted without
+# persistence) is told apart from an empty suppression list
+SENTINEL = ""
+# held by the process rebuilding the mirror, naming the set being built
+REBUILD_LOCK_KEY = f"{SUPPRESSED_EMAILS_KEY}:rebuild"
+REBUILD_LOCK_TTL = 300
+
+
+def normalize(email: str) -> str:
+    return email.strip().lower()
+
+
+def load_mirror(session: Session) -> Optional[int]:
+    """Rebuilds the redis set from the table into a key of its own, swapping
+    it in atomically. Returns None, without loading anything, when another
+    process is already rebuilding it."""
+    tmp_key = f"{SUPPRESSED_EMAILS_KEY}:loading:{uuid.uuid4().hex}"
+    if not redis_client.set(REBUILD_LOCK_KEY, tmp_key, nx=True, ex=REBUILD_LOCK_TTL):
+        return None
+
+    try:
+        redis_client.sadd(tmp_key, SENTINEL)
+        redis_client.expire(tmp_key, REBUILD_LOCK_TTL)
+
+        count, last_id = 0, 0
+        while True:
+            rows = session.exec(
+                select(Suppression.id, Suppression.email)
+                .where(Suppression.id > last_id)
+                .order_by(Suppression.id)
+                .limit(settings.CONTACT_IMPORT_CHUNK_SIZE)
+            ).all()
+            if not rows:
+                break
+            redis_client.sadd(tmp_key, *[row.email for row in rows])
+            count += len(rows)
+            last_id = rows[-1].id
+
+        redis_client.persist(tmp_key)
+        redis_client.rename(tmp_key, SUPPRESSED_EMAILS_KEY)
+    finally:
+        redis_client.delete(tmp_key)
+        if redis_client.get(REBUILD_LOCK_KEY) == tmp_key:
+            redis_client.delete(REBUILD_LOCK_KEY)
+
+    logger.info(f"Suppression mirror loaded with {count} emails")
+    return count
+
+
+def _suppressed_in_db(session: Session, emails: List[str]) -> Set[str]:
+    normalized = {normalize(email): email for email in emails}
+    found = set()
+    for chunk in chunked(list(normalized), settings.CONTACT_IMPORT_CHUNK_SIZE):
+        found.update(
+            session.exec(select(Suppression.email).where(Suppression.email.in_(chunk)))
+        )
+    return {normalized[email] for email in found}
+
+
+def suppressed(session: Session, emails: List[str]) -> Set[str]:
+    """Returns which of the emails are suppressed, in one redis round-trip,
+    or from the table while the mirror is being rebuilt."""
+    if not emails:
+        return set()
+
+    pipe = redis_client.pipeline()
+    pipe.exists(SUPPRESSED_EMAILS_KEY)
+    for email in emails:
+        pipe.sismember(SUPPRESSED_EMAILS_KEY, normalize(email))
+    loaded, *members = pipe.execute()
+
+    if not loaded:
+        if load_mirror(session) is None:
+            return _suppressed_in_db(session, emails)
+        return suppressed(session, emails)
+    return {email for email, member in zip(emails, members) if member}
+
+
+def _mirror_keys() -> List[str]:
+    """The mirror, if loaded, and the one being rebuilt, if any."""
+    keys = []
+    if redis_client.exists(SUPPRESSED_EMAILS_KEY):
+        keys.append(SUPPRESSED_EMAILS_KEY)
+    loading = redis_client.get(REBUILD_LOCK_KEY)
+    if loading:
+        keys.append(loading)
+    return keys
+
+
+def suppress(session: Session, emails: Iterable[str], reason: SuppressionReason) -> int:
+    """Adds emails to the suppression list, the ones already there being
+    kept as is. Returns the number of emails added; the caller commits, then
+    updates the mirror with `mirror_suppress`."""
+    emails = sorted({normalize(email) for email in emails if email.strip()})
+    created_at = datetime.now(timezone.utc)
+
+    added = 0
+    for chunk in chunked(emails, settings.CONTACT_IMPORT_CHUNK_SIZE):
+        result = session.execute(
+            upsert(session, Suppression)
+            .values(
+                [{"email": e, "reason": reason, "created_at": created_at} for e in chunk]
+            )
+            .on_conflict_do_nothing(index_elements=["email"])
+        )
+        added += result.rowcount
+    return added
+
+
+def mirror_suppress(emails: Iterable[str]):
+    """Makes committed suppressions effective right away; a missing mirror
+    is rebuilt on the next check."""
+    emails = sorted({normalize(email) for email in emails if email.strip()})
+    for key in _mirror_keys():
+        for chunk in chunked(emails, settings.CONTACT_IMPORT_CHUNK_SIZE):
+            redis_client.sadd(key, *chunk)
+
+
+def unsuppress(session: Session, email: str) -> int:
+    """Removes an email from the suppression list; the caller commits, then
+    calls `mirror_unsuppress`."""
+    result = session.execute(delete(Suppression).where(Suppression.email == normalize(email)))
+    return result.rowcount
+
+
+def mirror_unsuppress(email: str):
+    for key in _mirror_keys():
+        redis_client.srem(key, normalize(email))
@@ -0,0 +1,121 @@
+import random
+from datetime import datetime, timedelta, timezone
+from math import floor
+from typing import Optional
+
+from redis import Redis
+
+from app.cache import redis_client
+from app.ratelimit import RateLimiter
+from settings import settings
+
+
+# SMTP replies asking to slow down (too many connections / messages)
+THROTTLING_CODES = (421, 451)
+
+# Additive increase, multiplicative decrease of a domain's rate (mails per
+# minute), clamped and forgotten after a day without sending. The rate is
+# returned as a string, redis truncating lua numbers to integers.
+AIMD_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate') or ARGV[1])
+if ARGV[7] == 'increase' then
+    rate = math.min(rate + tonumber(ARGV[4]) / rate, tonumber(ARGV[3]))
+else
+    rate = math.max(rate * tonumber(ARGV[5]), tonumber(ARGV[2]))
+end
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+return tostring(rate)
+"""
+
+
+def recipient_domain(email: str) -> str:
+    return email.rsplit("@", 1)[-1].lower()
+
+
+def is_deferral(status_code: Optional[int]) -> bool:
+    """Temporary failures, worth sending again later: 4xx replies and
+    connection errors (no reply)."""
+    return status_code is None or 400 <= status_code < 500
+
+
+def deferral_delay(attempts: int) -> float:
+    """Exponential backoff with jitter, in seconds, for the nth deferral."""
+    delay = min(
+        settings.DEFERRAL_BACKOFF * 2 ** max(attempts - 1, 0),
+        settings.DEFERRAL_MAX_BACKOFF,
+    )
+    return random.uniform(delay / 2, delay)
+
+
+def defer_until(delay: float) -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=delay)
+
+
+class DomainThrottle(object):
+    """Sending rate per recipient domain, adapting to the domain's replies:
+    each accepted mail raises the rate a little (by `increase` per minute of
+    sending at full rate), each throttling reply divides it by `1 / decrease`.
+    The rates are shared by all the workers through redis."""
+
+    def __init__(
+        self,
+        client: Redis,
+        rate: float = 60,
+        min_rate: float = 1,
+        max_rate: float = 600,
+        increase: float = 1,
+        decrease: float = 0.5,
+        prefix: str = "throttle",
+    ):
+        self.client = client
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.prefix = prefix
+        self.limiter = RateLimiter(client, limits=[], prefix=f"{prefix}:window")
+        self._script = client.register_script(AIMD_SCRIPT)
+
+    def _key(self, domain: str) -> str:
+        return f"{self.prefix}:{domain}"
+
+    def get_rate(self, domain: str) -> float:
+        rate = self.client.hget(self._key(domain), "rate")
+        return float(rate) if rate else self.rate
+
+    def _update(self, domain: str, mode: str) -> float:
+        args = [
+            self.rate,
+            self.min_rate,
+            self.max_rate,
+            self.increase,
+            self.decrease,
+            24 * 60 * 60,
+            mode,
+        ]
+        return float(self._script(keys=[self._key(domain)], args=args))
+
+    def acquire(self, domain: str) -> float:
+        """Takes a send from the domain's budget over the last minute.
+        Returns 0 when granted, otherwise the seconds to wait."""
+        limit = max(floor(self.get_rate(domain)), 1)
+        return self.limiter.acquire(domain, limits=[(60, limit)])
+
+    def success(self, domain: str) -> float:
+        return self._update(domain, "increase")
+
+    def throttled(self, domain: str) -> float:
+        return self._update(domain, "decrease")
+
+
+def get_domain_throttle() -> DomainThrottle:
+    return DomainThrottle(
+        redis_client,
+        rate=settings.DOMAIN_RATE_PER_MINUTE,
+        min_rate=settings.DOMAIN_RATE_MIN,
+        max_rate=settings.DOMAIN_RATE_MAX,
+        increase=settings.DOMAIN_RATE_INCREASE,
+        decrease=settings.DOMAIN_RATE_DECREASE,
+    )
@@ -1,20 +1,42 @@
-from itsdangerous import URLSafeTimedSerializer
+from itertools import islice
+from typing import Iterable, Iterator, List
+
+from itsdangerous import BadData, URLSafeTimedSerializer
 from loguru import logger
 
 from settings import settings
 
 
+# tokens are signed with the last key, the previous ones are still accepted
+# when verifying so that links sent before a key rotation keep working
+serializer = URLSafeTimedSerializer(
+    [*settings.CONF_TOKEN_OLD_SECRET_KEYS, settings.CONF_TOKEN_SECRET_KEY],
+    salt=settings.CONF_TOKEN_PASSWORD_SALT,
+)
+signer = serializer.make_signer()
+
+
 def generate_confirmation_token(id_to_encode: str) -> str:
-    serializer = URLSafeTimedSerializer(settings.CONF_TOKEN_SECRET_KEY)
-    return serializer.dumps(id_to_encode, salt=settings.CONF_TOKEN_PASSWORD_SALT)
+    return signer.sign(serializer.dump_payload(id_to_encode)).decode("utf-8")
+
+
+def generate_confirmation_tokens(ids_to_encode: Iterable[str]) -> List[str]:
+    return [generate_confirmation_token(id_to_encode) for id_to_encode in ids_to_encode]
 
 
 def confirm_token(token: str) -> str:
-    serializer = URLSafeTimedSerializer(settings.CONF_TOKEN_SECRET_KEY)
     try:
-        decoded_id = serializer.loads(token, salt=settings.CONF_TOKEN_PASSWORD_SALT)
-    except:
+        decoded_id = serializer.loads(token)
+    except BadData:
         logger.info("token is not valid")
         return False
 
     return decoded_id
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
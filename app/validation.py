@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+from email_validator import (
+    EmailNotValidError,
+    caching_resolver,
+    validate_email,
+    validate_email_deliverability,
+)
+from loguru import logger
+
+from settings import settings
+
+
+class DomainCache(object):
+    """LRU of domain deliverability results with a TTL.
+
+    Deliverable domains are kept `ttl` seconds and undeliverable ones (the
+    error message being cached) `negative_ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600, negative_ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._domains = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, domain: str) -> Tuple[bool, Optional[str]]:
+        """Returns (found, error), error being None for deliverable domains."""
+        with self._lock:
+            entry = self._domains.get(domain)
+            if entry is not None and entry[0] > time.monotonic():
+                self._domains.move_to_end(domain)
+                self.stats["hits"] += 1
+                return True, entry[1]
+            self.stats["misses"] += 1
+            return False, None
+
+    def set(self, domain: str, error: Optional[str] = None):
+        ttl = self.negative_ttl if error else self.ttl
+        with self._lock:
+            self._domains[domain] = (time.monotonic() + ttl, error)
+            self._domains.move_to_end(domain)
+            if len(self._domains) > self.maxsize:
+                self._domains.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._domains.clear()
+
+
+class EmailValidator(object):
+    """Validates and normalizes emails, checking the deliverability of each
+    domain once per TTL rather than once per address.
+
+    `dns_resolver` is any object with the `resolve(name, record)` method of
+    dnspython's resolver (a stub one can be given to run without network).
+    """
+
+    def __init__(
+        self,
+        check_deliverability: bool = True,
+        dns_resolver=None,
+        cache: DomainCache = None,
+        timeout: float = 15,
+        max_workers: int = 16,
+    ):
+        self.check_deliverability = check_deliverability
+        self.dns_resolver = dns_resolver or caching_resolver(timeout=timeout)
+        self.cache = cache or DomainCache()
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def check_domain(self, domain: str, domain_i18n: str = None) -> Optional[str]:
+        """Returns None if the domain accepts emails, otherwise the reason."""
+        found, error = self.cache.get(domain)
+        if found:
+            return error
+
+        try:
+            info = validate_email_deliverability(
+                domain, domain_i18n or domain, self.timeout, self.dns_resolver
+            )
+        except EmailNotValidError as e:
+            error = str(e)
+        else:
+            # a DNS timeout says nothing about the domain, don't cache it
+            if "unknown-deliverability" in info:
+                return None
+        self.cache.set(domain, error)
+        return error
+
+    def validate(self, email: str, check_deliverability: bool = None) -> Optional[str]:
+        """Returns the normalized email, or None if it is not valid."""
+        return self.validate_many([email], check_deliverability)[0]
+
+    def validate_many(
+        self, emails: Iterable[str], check_deliverability: bool = None
+    ) -> List[Optional[str]]:
+        """Validates a batch of emails: the syntax of every address, then the
+        deliverability of each distinct domain, resolved in parallel."""
+        if check_deliverability is None:
+            check_deliverability = self.check_deliverability
+
+        results = []
+        domains = {}
+        for email in emails:
+            try:
+                validated = validate_email(email, check_deliverability=False)
+            except EmailNotValidError as e:
+                # email is not valid, exception message is human-readable
+                logger.info(str(e))
+                results.append(None)
+                continue
+            results.append(validated)
+            domains[validated.ascii_domain] = validated.domain
+
+        errors = {}
+        if check_deliverability and domains:
+            errors = dict(
+                zip(domains, self.executor.map(self.check_domain, domains, domains.values()))
+            )
+
+        emails = []
+        for validated in results:
+            if validated is None:
+                emails.append(None)
+            elif errors.get(validated.ascii_domain):
+                logger.info(errors[validated.ascii_domain])
+                emails.append(None)
+            else:
+                emails.append(validated.email)
+        return emails
+
+
+email_validator = EmailValidator(
+    check_deliverability=settings.EMAIL_CHECK_DELIVERABILITY,
+    cache=DomainCache(
+        maxsize=settings.EMAIL_DOMAIN_CACHE_SIZE,
+        ttl=settings.EMAIL_DOMAIN_CACHE_TTL,
+        negative_ttl=settings.EMAIL_DOMAIN_NEGATIVE_TTL,
+    ),
+    timeout=settings.EMAIL_DNS_TIMEOUT,
+    max_workers=settings.EMAIL_VALIDATION_WORKERS,
+)
@@ -1,12 +1,47 @@
+import random
+import time
+from collections import Counter, defaultdict, deque
 from celery import Celery
+from celery.signals import worker_process_shutdown
 from datetime import datetime, timezone
 from loguru import logger
+from sqlmodel import func, select
+from typing import Dict, List, Optional, Set
 
 from settings import settings
-from app.crud import CRUDContact, CRUDMail
+from app.contact_cache import contact_cache, contact_record
+from app.crud import CRUDMail
 from app.db import Session, engine
-from app.mails import send_email
-from app.models import Mail, MailCreate, Contact
+from app.delivery import get_delivery_engine
+from app.mails import (
+    DEFAULT_CAMPAIGN_TEMPLATE,
+    send_email,
+    submit_email,
+    template_cache,
+)
+from app.smtp import SMTPResult, get_smtp_pools
+from app.models import (
+    Campaign,
+    CampaignStats,
+    Contact,
+    ContactCampaignLink,
+    Mail,
+    MailStatus,
+)
+from app.events import pop_opens
+from app.latency import BULK, TRANSACTIONAL, record_latencies
+from app.progress import account_counts, incr_progress
+from app.senders import sender_pool
+from app.suppression import suppressed
+from app.throttle import (
+    THROTTLING_CODES,
+    defer_until,
+    deferral_delay,
+    get_domain_throttle,
+    is_deferral,
+    recipient_domain,
+)
+from app.utils import generate_confirmation_tokens
 
 
 celery_app = Celery(
@@ -15,56 +50,482 @@ celery_app = Celery(
     broker=settings.REDISCLOUD_URL,
     celery_task_track_started=True,
 )
+# one-off mails do not wait behind the campaigns: run dedicated workers for
+# each queue (see README), the periodic tasks staying on the default one
+celery_app.conf.task_routes = {
+    "app.worker.send_email_task": {"queue": TRANSACTIONAL},
+    "app.worker.send_campaign_batch_task": {"queue": BULK},
+    "app.worker.start_campaign_task": {"queue": BULK},
+}
+celery_app.conf.beat_schedule = {
+    "flush-opens": {
+        "task": "app.worker.flush_opens_task",
+        "schedule": settings.OPENS_FLUSH_INTERVAL,
+    },
+    "dispatch-scheduled-mails": {
+        "task": "app.worker.dispatch_scheduled_mails_task",
+        "schedule": settings.SCHEDULE_DISPATCH_INTERVAL,
+    },
+    "reap-sending-mails": {
+        "task": "app.worker.reap_sending_mails_task",
+        "schedule": settings.SENDING_REAP_INTERVAL,
+    },
+}
+
+throttle = get_domain_throttle()
+
+
+@worker_process_shutdown.connect
+def close_worker_process(**kwargs):
+    for address, pool in get_smtp_pools().items():
+        logger.info(f"SMTP pool stats ({address}) : {pool.stats}")
+        pool.close()
+    logger.info(
+        f"Template cache stats : {template_cache.stats}, hit rate {template_cache.hit_rate:.2%}"
+    )
+    logger.info(f"Contact cache stats : {contact_cache.stats}")
+
+    if settings.SMTP_ASYNC:
+        engine = get_delivery_engine()
+        for address, pool in engine.pools.items():
+            logger.info(f"Async SMTP pool stats ({address}) : {pool.stats}")
+        engine.close()
+
+
+def is_suppressed(contact: dict, blocked: Set[str]) -> bool:
+    return contact["status"] == "unsubscribed" or contact["email"] in blocked
+
 
+def throttled_until(wait: float) -> datetime:
+    # spread the mails deferred together, not to send them back in a burst
+    return defer_until(wait * random.uniform(1, 1.5))
 
-@celery_app.task(bind=True)
+
+def record_result(
+    mail,
+    domain: str,
+    r: SMTPResult,
+    sent: Dict[int, Optional[datetime]],
+    failed: Dict[int, Optional[datetime]],
+    retried: Dict[int, datetime],
+):
+    """Files the mail by its SMTP reply, adapting the domain's rate: accepted
+    (sent), temporary failure sent again later with backoff (retried) until
+    `DEFERRAL_MAX_ATTEMPTS`, otherwise failed."""
+    if r.status_code == 250:
+        sent[mail.id] = datetime.now(timezone.utc)
+        throttle.success(domain)
+        return
+
+    if r.status_code in THROTTLING_CODES:
+        rate = throttle.throttled(domain)
+        logger.info(f"Throttled by {domain}, rate down to {rate:.1f} mails/min")
+    if is_deferral(r.status_code) and mail.attempts + 1 < settings.DEFERRAL_MAX_ATTEMPTS:
+        logger.info(f"Mail {mail.id} deferred cause of : {r.status_code}")
+        retried[mail.id] = defer_until(deferral_delay(mail.attempts + 1))
+    else:
+        logger.info(f"Mail cannot be send cause of : {r.status_code}")
+        failed[mail.id] = None
+
+
+@celery_app.task
 def send_email_task(
-    self,
-    email_to: str,
-    name_from: str,
-    html_template: str,
-    subject: str,
-    campaign_id: int = None,
-    infos_to_render: dict = {},
+    mail_id: int,
     unsubscribe_link: bool = False,
     pixel_link: bool = False,
+    contact: dict = None,
+    enqueued_at: float = None,
 ):
+    """Sends a mail created beforehand (see `POST /mails`), `contact` being
+    the record of its contact (see `contact_record`) when the caller has it.
+    `enqueued_at` (a timestamp) measures the latency to the SMTP reply."""
 
-    crud_contact = CRUDContact(model=Contact)
     crud_mail = CRUDMail(model=Mail)
 
     with Session(engine) as session:
-        day_count = Mail.day_count(session=session)
+        claimed_at = datetime.now(timezone.utc)
+        mails = crud_mail.claim(session=session, ids=[mail_id], claimed_at=claimed_at)
+        if not mails:
+            logger.info(f"Mail {mail_id} was deleted, or is already sent")
+            return
+        mail = mails[0]
 
-        contact = crud_contact.get_by_email(session=session, email=email_to)
+        contact = contact_cache.get(session, mail.contact_id, prefetched=contact)
+        if not contact:
+            logger.info(f"Contact {mail.contact_id} does not exist anymore")
+            crud_mail.set_status(
+                session, MailStatus.failed, {mail.id: None}, claimed_at
+            )
+            session.commit()
+            return
+
+        if is_suppressed(contact, suppressed(session, [contact["email"]])):
+            logger.info(f"Mail {mail.id} dropped, {contact['email']} is suppressed")
+            crud_mail.set_status(
+                session, MailStatus.suppressed, {mail.id: None}, claimed_at
+            )
+            session.commit()
+            return
 
-        mail_obj = MailCreate(contact_id=contact.id, campaign_id=campaign_id)
-        mail = crud_mail.create(session=session, obj=mail_obj)
+        domain = recipient_domain(contact["email"])
+        wait = throttle.acquire(domain)
+        if wait:
+            logger.info(f"Sending rate of {domain} reached, mail {mail.id} deferred")
+            crud_mail.defer(session, {mail.id: throttled_until(wait)}, claimed_at)
+            session.commit()
+            return
 
-        logger.debug(f"Day count : {day_count}")
+        # taken last, not to spend the budget on mails that are not sent;
+        # over the limits, sent again by the scheduled mails dispatcher
+        account, retry_after = sender_pool.wait(max_sleep=settings.RATE_LIMIT_MAX_SLEEP)
+        if retry_after:
+            logger.info(f"Sending limit reached, mail {mail.id} deferred")
+            until = throttled_until(retry_after)
+            crud_mail.defer(session, {mail.id: until}, claimed_at)
+            session.commit()
+            return
 
-        # reschedule task if we reach the daily limit
-        if day_count > settings.DAILY_LIMIT:
-            logger.info("Daily limit reached")
-            # retry in one hour
-            self.retry(countdown=60 * 60)
-        else:
+        try:
             r = send_email(
-                email_to=email_to,
-                name_from=name_from,
-                html_template=html_template,
-                subject=subject,
-                infos_to_render=infos_to_render,
+                email_to=contact["email"],
+                account=account,
+                name_from=mail.sender_name,
+                html_template=mail.html_template,
+                subject=mail.subject,
+                infos_to_render=contact["meta"],
                 unsubscribe_link=unsubscribe_link,
-                contact_id=contact.id,
+                contact_id=contact["id"],
                 pixel_link=pixel_link,
                 email_id=mail.id,
             )
+        except Exception as e:
+            logger.warning(f"Mail {mail.id} cannot be rendered : {e!r}")
+            if crud_mail.held(session, [mail.id], claimed_at):
+                crud_mail.set_status(
+                    session, MailStatus.failed, {mail.id: None}, claimed_at
+                )
+                CampaignStats.incr(session, mail.campaign_id, mails=1, failed=1)
+            session.commit()
+            return
+
+        sent, failed, retried = {}, {}, {}
+        record_result(mail, domain, r, sent, failed, retried)
+        if sent:
+            logger.info(f"Mail {mail.id} is send")
+            if enqueued_at:
+                record_latencies(TRANSACTIONAL, [time.time() - enqueued_at])
+        if not crud_mail.held(session, [mail.id], claimed_at):
+            logger.info(f"Mail {mail.id} was reaped while being sent")
+            session.commit()
+            return
+        crud_mail.set_status(session, MailStatus.sent, sent, claimed_at)
+        crud_mail.set_status(session, MailStatus.failed, failed, claimed_at)
+        crud_mail.defer(session, retried, claimed_at, attempt=True)
+        if sent or failed:
+            CampaignStats.incr(
+                session, mail.campaign_id, mails=1, sent=len(sent), failed=len(failed)
+            )
+        session.commit()
+
+
+@celery_app.task
+def send_campaign_batch_task(
+    campaign_id: int,
+    mail_ids: List[int],
+    contacts: List[dict] = (),
+    enqueued_at: float = None,
+):
+    """Renders and sends a whole chunk of a campaign with one DB session,
+    the campaign template being loaded once instead of shipped with every task.
+    `contacts` are the records of the chunk prefetched by the producer.
+
+    Campaigns only use `1 - TRANSACTIONAL_RATE_SHARE` of the sending limits,
+    the rest being kept for the one-off mails.
+
+    The mails are claimed first, so a retried task only sends the mails
+    that are still queued or deferred. The claim is renewed while the batch
+    runs, a mail reaped meanwhile being skipped rather than sent twice."""
+    crud_mail = CRUDMail(model=Mail)
+
+    with Session(engine) as session:
+        campaign = session.get(Campaign, campaign_id)
+        if not campaign:
+            logger.info(f"Campaign {campaign_id} does not exist anymore")
+            return
+        html_template = campaign.html_template or DEFAULT_CAMPAIGN_TEMPLATE
+        name_from, subject = campaign.sender_name, campaign.subject
+
+        claimed_at = datetime.now(timezone.utc)
+        mails = crud_mail.claim(session=session, ids=mail_ids, claimed_at=claimed_at)
+        held = {mail.id for mail in mails}
+        renewed = time.monotonic()
+
+        sent, failed, dropped = {}, {}, {}
+        deferred, retried = {}, {}
+        throttled = {}  # domain -> until
+        retry_until = None  # sending limits reached
+        in_flight = defaultdict(deque)  # domain -> (mail, future)
+        senders = {}  # mail id -> sender address
+        replied_at = {}  # mail id -> time its SMTP reply was collected
+
+        # the claimed mails are written back whatever happens, the ones left
+        # over (not sent nor failed) being reaped by `reap_sending_mails_task`
+        try:
+            records = contact_cache.get_many(
+                session, [mail.contact_id for mail in mails], prefetched=contacts
+            )
+            blocked = suppressed(session, [r["email"] for r in records.values()])
+            unsubscribe_tokens = dict(
+                zip(records, generate_confirmation_tokens(list(records)))
+            )
+
+            # grouped by domain, a throttled domain not holding back the others
+            domains = {
+                mail.id: recipient_domain(records[mail.contact_id]["email"])
+                for mail in mails
+                if mail.contact_id in records
+            }
+            mails = sorted(mails, key=lambda mail: domains.get(mail.id, ""))
+
+            for mail in mails:
+                # keeps the claim ahead of the reaper on long batches
+                if time.monotonic() - renewed >= settings.SENDING_TIMEOUT / 3:
+                    held, claimed_at = crud_mail.renew_claim(
+                        session, list(held), claimed_at
+                    )
+                    renewed = time.monotonic()
+                if mail.id not in held:
+                    logger.info(f"Mail {mail.id} was reaped, not sent")
+                    continue
+
+                contact = records.get(mail.contact_id)
+                if not contact:
+                    failed[mail.id] = None
+                    continue
+                # dropped before rendering, not taken from the sending budget
+                if is_suppressed(contact, blocked):
+                    dropped[mail.id] = None
+                    continue
+
+                domain = domains[mail.id]
+                if retry_until or domain in throttled:
+                    deferred[mail.id] = retry_until or throttled[domain]
+                    continue
+                wait = throttle.acquire(domain)
+                if wait:
+                    throttled[domain] = throttled_until(wait)
+                    deferred[mail.id] = throttled[domain]
+                    continue
+                account, retry_after = sender_pool.wait(
+                    max_sleep=settings.RATE_LIMIT_MAX_SLEEP,
+                    share=1 - settings.TRANSACTIONAL_RATE_SHARE,
+                )
+                if retry_after:
+                    retry_until = throttled_until(retry_after)
+                    deferred[mail.id] = retry_until
+                    continue
 
-            if r.status_code == 250:
-                mail.time_send = datetime.now(timezone.utc)
-                logger.info(f"Mail {mail.id} is send")
-                session.add(mail)
-                session.commit()
-            else:
-                logger.info(f"Mail cannot be send cause of : {r.status_code}")
+                # at most DOMAIN_CONCURRENCY messages in flight to a domain
+                pending = in_flight[domain]
+                if len(pending) >= settings.DOMAIN_CONCURRENCY:
+                    done, future = pending.popleft()
+                    r = future.result()
+                    replied_at[done.id] = time.time()
+                    record_result(done, domain, r, sent, failed, retried)
+
+                # with SMTP_ASYNC, the next mails are rendered while this one is sent
+                try:
+                    future = submit_email(
+                        email_to=contact["email"],
+                        account=account,
+                        name_from=name_from,
+                        html_template=html_template,
+                        subject=subject,
+                        infos_to_render=contact["meta"],
+                        unsubscribe_link=True,
+                        contact_id=contact["id"],
+                        pixel_link=True,
+                        email_id=mail.id,
+                        unsubscribe_token=unsubscribe_tokens[contact["id"]],
+                    )
+                except Exception as e:
+                    logger.warning(f"Mail {mail.id} cannot be rendered : {e!r}")
+                    failed[mail.id] = None
+                    continue
+                pending.append((mail, future))
+                senders[mail.id] = account.address
+        finally:
+            for domain, pending in in_flight.items():
+                for mail, future in pending:
+                    r = future.result()
+                    replied_at[mail.id] = time.time()
+                    record_result(mail, domain, r, sent, failed, retried)
+
+            # only the mails still held are written back and counted
+            held = crud_mail.held(session, list(held), claimed_at)
+            for results in (sent, failed, dropped, deferred, retried):
+                for mail_id in set(results) - held:
+                    del results[mail_id]
+            crud_mail.set_status(session, MailStatus.sent, sent, claimed_at)
+            crud_mail.set_status(session, MailStatus.failed, failed, claimed_at)
+            crud_mail.set_status(session, MailStatus.suppressed, dropped, claimed_at)
+            # sent again by the scheduled mails dispatcher
+            crud_mail.defer(session, deferred, claimed_at)
+            crud_mail.defer(session, retried, claimed_at, attempt=True)
+            CampaignStats.incr(
+                session,
+                campaign_id,
+                mails=len(sent) + len(failed),
+                sent=len(sent),
+                failed=len(failed),
+            )
+            session.commit()
+            logger.info(f"Campaign {campaign_id} : {len(sent)}/{len(mails)} mails sent")
+
+            if enqueued_at:
+                record_latencies(BULK, [replied_at[id] - enqueued_at for id in sent])
+
+            if deferred or retried:
+                logger.info(
+                    f"Campaign {campaign_id} : {len(deferred)} mails deferred by the "
+                    f"sending limits, {len(retried)} by the recipients' servers"
+                )
+            incr_progress(
+                campaign_id,
+                sent=len(sent),
+                failed=len(failed),
+                deferred=len(deferred) + len(retried),
+                suppressed=len(dropped),
+                **account_counts(Counter(senders[id] for id in sent)),
+            )
+
+
+@celery_app.task
+def start_campaign_task(campaign_id: int):
+    """Streams the campaign's contacts by keyset pages of the link table,
+    creates their mails (once, by idempotency key) and enqueues one batch
+    task per page, with the contacts' records."""
+
+    crud_mail = CRUDMail(model=Mail)
+    batch_size = settings.CAMPAIGN_BATCH_SIZE
+    last_contact_id = 0
+
+    with Session(engine) as session:
+        total = session.exec(
+            select(func.count()).where(ContactCampaignLink.campaign_id == campaign_id)
+        ).one()
+        incr_progress(campaign_id, total=total)
+
+        while True:
+            contacts = session.exec(
+                select(Contact.id, Contact.email, Contact.meta, Contact.status)
+                .join(ContactCampaignLink, ContactCampaignLink.contact_id == Contact.id)
+                .where(
+                    ContactCampaignLink.campaign_id == campaign_id,
+                    ContactCampaignLink.contact_id > last_contact_id,
+                )
+                .order_by(ContactCampaignLink.contact_id)
+                .limit(batch_size)
+            ).all()
+            if not contacts:
+                break
+            last_contact_id = contacts[-1].id
+
+            # no mail is created for the suppressed contacts
+            records = [contact_record(c) for c in contacts]
+            blocked = suppressed(session, [r["email"] for r in records])
+            records = [r for r in records if not is_suppressed(r, blocked)]
+            incr_progress(campaign_id, suppressed=len(contacts) - len(records))
+            if not records:
+                continue
+
+            mail_ids = crud_mail.queue(
+                session=session,
+                mails=[
+                    {
+                        "campaign_id": campaign_id,
+                        "contact_id": r["id"],
+                        "idempotency_key": Mail.campaign_key(campaign_id, r["id"]),
+                    }
+                    for r in records
+                ],
+            )
+            session.commit()
+
+            send_campaign_batch_task.delay(
+                campaign_id=campaign_id,
+                mail_ids=mail_ids,
+                contacts=records,
+                enqueued_at=time.time(),
+            )
+            incr_progress(campaign_id, enqueued=len(mail_ids))
+
+    logger.info(f"Campaign {campaign_id} : {total} contacts enqueued")
+
+
+@celery_app.task
+def dispatch_scheduled_mails_task():
+    """Enqueues the scheduled mails that are due, by batches, the deferred
+    campaign mails going back to a batch task per campaign.
+
+    Mails are enqueued before the claim is committed: if the dispatcher dies
+    in between they are dispatched again, and the worker skips the ones
+    already sent."""
+    crud_mail = CRUDMail(model=Mail)
+
+    with Session(engine) as session:
+        while True:
+            mails = crud_mail.claim_due(
+                session=session, limit=settings.SCHEDULE_DISPATCH_BATCH_SIZE
+            )
+            if not mails:
+                break
+            campaigns = defaultdict(list)
+            for mail in mails:
+                key = Mail.campaign_key(mail.campaign_id, mail.contact_id)
+                if mail.campaign_id and mail.idempotency_key == key:
+                    campaigns[mail.campaign_id].append(mail.id)
+                    continue
+                send_email_task.delay(
+                    mail_id=mail.id,
+                    unsubscribe_link=True,
+                    pixel_link=True,
+                    enqueued_at=time.time(),
+                )
+            for campaign_id, mail_ids in campaigns.items():
+                send_campaign_batch_task.delay(
+                    campaign_id=campaign_id, mail_ids=mail_ids, enqueued_at=time.time()
+                )
+            session.commit()
+            logger.info(f"{len(mails)} scheduled mails dispatched")
+
+
+@celery_app.task
+def reap_sending_mails_task():
+    """Gives back to the dispatcher the mails claimed more than
+    `SENDING_TIMEOUT` seconds ago and still `sending`, their task having died
+    (worker killed, lost connection) before writing their status. Such a mail
+    may have been sent already: it is sent at least once."""
+    crud_mail = CRUDMail(model=Mail)
+
+    with Session(engine) as session:
+        deferred, failed = crud_mail.reap(
+            session=session, timeout=settings.SENDING_TIMEOUT
+        )
+        session.commit()
+    if deferred or failed:
+        logger.info(f"Stale mails reaped : {deferred} deferred, {failed} failed")
+
+
+@celery_app.task
+def flush_opens_task():
+    """Writes the mails opened since the last run, by batches."""
+    crud_mail = CRUDMail(model=Mail)
+
+    with Session(engine) as session:
+        while True:
+            mail_ids = pop_opens(settings.OPENS_FLUSH_BATCH_SIZE)
+            if not mail_ids:
+                break
+            opened = crud_mail.mark_opened(session=session, ids=mail_ids)
+            logger.info(f"{opened}/{len(mail_ids)} mails opened for the first time")
@@ -0,0 +1,104 @@
+"""Query plans of the hot paths before and after the indexes migrations.
+
+Seeds an empty PostgreSQL database with 1M contacts, links and mails, then
+runs EXPLAIN ANALYZE on the hot queries at the revision preceding the
+indexes and again at head. Point DATABASE_URL to a throwaway database:
+
+    DATABASE_URL=postgresql://localhost/tinymail_bench python -m benchmarks.query_plans
+"""
+import sys
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect, text
+from sqlmodel import create_engine
+
+from settings import settings
+
+
+ROWS = 1_000_000
+CAMPAIGNS = 10
+# last revision without the unique email index and the hot path indexes
+BEFORE_REVISION = "5f1c9a7e2b3d"
+
+SEED = [
+    f"""
+    INSERT INTO campaign (name, html_template, sender_name, subject, started)
+    SELECT 'campaign ' || i, '', '', '', true FROM generate_series(1, {CAMPAIGNS}) i
+    """,
+    f"""
+    INSERT INTO contact (email, meta, status)
+    SELECT 'user' || i || '@example.com', '{{}}', 'non-subscribed'
+    FROM generate_series(1, {ROWS}) i
+    """,
+    f"""
+    INSERT INTO contactcampaignlink (campaign_id, contact_id)
+    SELECT 1 + i % {CAMPAIGNS}, i FROM generate_series(1, {ROWS}) i
+    """,
+    f"""
+    INSERT INTO mail (contact_id, campaign_id, is_open, time_send)
+    SELECT
+        i,
+        1 + i % {CAMPAIGNS},
+        random() < 0.2,
+        CASE WHEN random() < 0.05 THEN NULL ELSE now() - random() * interval '30 days' END
+    FROM generate_series(1, {ROWS}) i
+    """,
+]
+
+QUERIES = {
+    "contact by email": "SELECT * FROM contact WHERE email = 'user654321@example.com'",
+    "mails of the day": "SELECT count(mail.id) FROM mail WHERE time_send >= now() - interval '24 hours'",
+    "mails of a campaign": "SELECT * FROM mail WHERE campaign_id = 3 ORDER BY id LIMIT 20",
+    "mails of a contact": "SELECT * FROM mail WHERE contact_id = 123456",
+    "unsent mails of a campaign": "SELECT count(*) FROM mail WHERE campaign_id = 3 AND time_send IS NULL",
+    "campaigns of a contact": "SELECT campaign_id FROM contactcampaignlink WHERE contact_id = 123456",
+}
+
+
+def explain(connection, query: str):
+    plan = [
+        row[0]
+        for row in connection.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {query}"))
+    ]
+    execution_time = next(
+        float(line.split(":")[1].strip().split(" ")[0])
+        for line in plan
+        if line.startswith("Execution Time")
+    )
+    return plan, execution_time
+
+
+def run_queries(engine, label: str):
+    timings = {}
+    with engine.connect() as connection:
+        connection.execute(text("ANALYZE"))
+        for name, query in QUERIES.items():
+            plan, timings[name] = explain(connection, query)
+            print(f"\n### {label} - {name}\n")
+            print("\n".join(plan))
+    return timings
+
+
+def main():
+    engine = create_engine(settings.DATABASE_URL)
+    if inspect(engine).has_table("contact"):
+        sys.exit("The benchmark must run on an empty database")
+
+    config = Config("alembic.ini")
+    command.upgrade(config, BEFORE_REVISION)
+    with engine.begin() as connection:
+        for statement in SEED:
+            connection.execute(text(statement))
+
+    before = run_queries(engine, "before")
+    command.upgrade(config, "head")
+    after = run_queries(engine, "after")
+
+    print(f"\n{'query':<30}{'before (ms)':>15}{'after (ms)':>15}")
+    for name in QUERIES:
+        print(f"{name:<30}{before[name]:>15.3f}{after[name]:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Throughput of the SMTP delivery, blocking pool vs asyncio engine.
+
+Sends the same messages to a local SMTP sink (aiosmtpd) answering every
+message after an injected latency, through the connection pool used by
+default (one message at a time, like a prefork worker process) and through
+the asyncio delivery engine (SMTP_ASYNC):
+
+    python -m benchmarks.smtp_delivery --messages 500 --latency 0.05 --connections 8
+"""
+import argparse
+import asyncio
+import time
+
+from aiosmtpd.controller import Controller
+
+from app.delivery import AsyncSMTPPool, DeliveryEngine
+from app.smtp import SMTPConnectionPool
+
+
+HOST, PORT = "127.0.0.1", 8025
+MESSAGE = "Subject: benchmark\r\n\r\n" + "Hello from Tinymail.\r\n" * 100
+
+
+class SlowSink(object):
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.latency)
+        self.received += 1
+        return "250 OK"
+
+
+def report(name: str, messages: int, seconds: float):
+    print(f"{name:<30}{messages / seconds:>10.1f} msgs/s{seconds:>10.2f}s")
+
+
+def bench_pool(messages: int) -> float:
+    pool = SMTPConnectionPool(HOST, PORT, ssl=False, user="", password="", max_messages=messages)
+    start = time.perf_counter()
+    for _ in range(messages):
+        assert pool.sendmail("from@example.com", ["to@example.com"], MESSAGE).status_code == 250
+    seconds = time.perf_counter() - start
+    pool.close()
+    return seconds
+
+
+def bench_engine(messages: int, connections: int, max_pending: int) -> float:
+    pool = AsyncSMTPPool(
+        HOST,
+        PORT,
+        ssl=False,
+        user="",
+        password="",
+        max_connections=connections,
+        max_messages=messages,
+    )
+    engine = DeliveryEngine({"from@example.com": pool}, max_pending=max_pending)
+    start = time.perf_counter()
+    futures = [
+        engine.submit("from@example.com", ["to@example.com"], MESSAGE)
+        for _ in range(messages)
+    ]
+    assert all(f.result().status_code == 250 for f in futures)
+    seconds = time.perf_counter() - start
+    engine.close()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument("--max-pending", type=int, default=100)
+    args = parser.parse_args()
+
+    sink = SlowSink(args.latency)
+    controller = Controller(sink, hostname=HOST, port=PORT)
+    controller.start()
+    try:
+        print(f"{args.messages} messages, {args.latency * 1000:.0f}ms per message")
+        report("pool (blocking)", args.messages, bench_pool(args.messages))
+        for connections in sorted({1, args.connections}):
+            seconds = bench_engine(args.messages, connections, args.max_pending)
+            report(f"engine ({connections} connections)", args.messages, seconds)
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
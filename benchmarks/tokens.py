@@ -0,0 +1,60 @@
+"""Throughput of the tracking tokens generation and verification.
+
+Compares the module-level signer of `app.utils` with the previous
+implementation, which built a new serializer on every call:
+
+    python -m benchmarks.tokens
+"""
+import timeit
+
+from itsdangerous import URLSafeTimedSerializer
+
+from app.utils import (
+    confirm_token,
+    generate_confirmation_token,
+    generate_confirmation_tokens,
+)
+from settings import settings
+
+
+N = 20_000
+
+
+def generate_confirmation_token_before(id_to_encode: str) -> str:
+    serializer = URLSafeTimedSerializer(settings.CONF_TOKEN_SECRET_KEY)
+    return serializer.dumps(id_to_encode, salt=settings.CONF_TOKEN_PASSWORD_SALT)
+
+
+def confirm_token_before(token: str) -> str:
+    serializer = URLSafeTimedSerializer(settings.CONF_TOKEN_SECRET_KEY)
+    try:
+        return serializer.loads(token, salt=settings.CONF_TOKEN_PASSWORD_SALT)
+    except Exception:
+        return False
+
+
+def report(name: str, seconds: float):
+    print(f"{name:<30}{N / seconds:>12.0f} ops/s")
+
+
+def main():
+    token = generate_confirmation_token(123456)
+    assert confirm_token_before(token) == confirm_token(token) == 123456
+
+    benchmarks = {
+        "generate (before)": lambda: generate_confirmation_token_before(123456),
+        "generate (after)": lambda: generate_confirmation_token(123456),
+        "confirm (before)": lambda: confirm_token_before(token),
+        "confirm (after)": lambda: confirm_token(token),
+    }
+    for name, func in benchmarks.items():
+        report(name, timeit.timeit(func, number=N))
+
+    report(
+        "generate batch (after)",
+        timeit.timeit(lambda: generate_confirmation_tokens(range(N)), number=1),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,96 @@
-from typing import Optional
+from typing import List, Optional
 
-from pydantic import BaseSettings
+from pydantic import BaseModel, BaseSettings, validator
+
+
+class SenderAccount(BaseModel):
+    """An SMTP account mails are sent from, with its own sending limits."""
+
+    address: str
+    password: str
+    smtp_host: str
+    smtp_port: int
+    smtp_ssl: bool = True
+    daily_limit: Optional[int] = None
+    rate_limit_per_minute: Optional[int] = None
+    rate_limit_per_second: Optional[int] = None
+
+    @validator("daily_limit", always=True)
+    def default_daily_limit(cls, v, values):
+        if v:
+            return v
+        if values.get("address", "").endswith("gmail.com"):
+            return 500-100 # gmail free
+        return 2000-100 # workspace
 
 
 class Settings(BaseSettings):
 
     ENV_STATE: str
 
-    MAIL_ADDRESS: str
-    MAIL_PWD: str
-    SMTP_HOST: str
-    SMTP_PORT: int
-    SMTP_SSL: bool
+    # JSON list of accounts, see SenderAccount, or a single account below
+    SENDER_ACCOUNTS: List[SenderAccount] = []
+    MAIL_ADDRESS: Optional[str] = None
+    MAIL_PWD: Optional[str] = None
+    SMTP_HOST: Optional[str] = None
+    SMTP_PORT: Optional[int] = None
+    SMTP_SSL: bool = True
+    SMTP_TIMEOUT: int = 30
+    SMTP_POOL_SIZE: int = 2
+    SMTP_POOL_MAX_MESSAGES: int = 100
+    SMTP_POOL_MAX_AGE: int = 300
+    SMTP_ASYNC: bool = False
+    SMTP_ASYNC_CONNECTIONS: int = 8
+    SMTP_ASYNC_MAX_PENDING: int = 100
+    TEMPLATE_CACHE_SIZE: int = 128
+    CONTACT_CACHE_SIZE: int = 10000
+    CONTACT_CACHE_TTL: int = 300
 
     CONF_TOKEN_SECRET_KEY: str
     CONF_TOKEN_PASSWORD_SALT: str
+    CONF_TOKEN_OLD_SECRET_KEYS: List[str] = []
 
     DATABASE_URL: str
+    ASYNC_DATABASE_URL: Optional[str] = None
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_RECYCLE: int = 1800
     REDISCLOUD_URL: str
     BASE_URL: str
     UNSUBSCRIBE_URL: Optional[str] = None
     PIXEL_URL: Optional[str] = None
 
     DAILY_LIMIT: Optional[int] = None
+    RATE_LIMIT_PER_SECOND: Optional[int] = None
+    RATE_LIMIT_PER_MINUTE: Optional[int] = None
+    RATE_LIMIT_MAX_SLEEP: float = 5
+    TRANSACTIONAL_RATE_SHARE: float = 0.2
+    LATENCY_SAMPLES: int = 1000
+    DOMAIN_RATE_PER_MINUTE: float = 60
+    DOMAIN_RATE_MIN: float = 1
+    DOMAIN_RATE_MAX: float = 600
+    DOMAIN_RATE_INCREASE: float = 1
+    DOMAIN_RATE_DECREASE: float = 0.5
+    DOMAIN_CONCURRENCY: int = 4
+    DEFERRAL_BACKOFF: int = 60
+    DEFERRAL_MAX_BACKOFF: int = 3600
+    DEFERRAL_MAX_ATTEMPTS: int = 5
+    MAX_PAGE_SIZE: int = 1000
+    EXPORT_BATCH_SIZE: int = 1000
+    CAMPAIGN_BATCH_SIZE: int = 500
+    CONTACT_IMPORT_CHUNK_SIZE: int = 5000
+    EMAIL_VALIDATION_WORKERS: int = 16
+    EMAIL_CHECK_DELIVERABILITY: bool = True
+    EMAIL_DNS_TIMEOUT: float = 15
+    EMAIL_DOMAIN_CACHE_SIZE: int = 10000
+    EMAIL_DOMAIN_CACHE_TTL: int = 3600
+    EMAIL_DOMAIN_NEGATIVE_TTL: int = 300
+    OPENS_FLUSH_INTERVAL: float = 5
+    OPENS_FLUSH_BATCH_SIZE: int = 1000
+    SCHEDULE_DISPATCH_INTERVAL: float = 5
+    SCHEDULE_DISPATCH_BATCH_SIZE: int = 500
+    SENDING_TIMEOUT: int = 900
+    SENDING_REAP_INTERVAL: float = 60
 
     class Config:
         """Loads the dotenv file."""
@@ -34,13 +102,35 @@ class Settings(BaseSettings):
         if self.DATABASE_URL and self.DATABASE_URL.startswith("postgres://"):
             self.DATABASE_URL = self.DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+        if not self.ASYNC_DATABASE_URL:
+            self.ASYNC_DATABASE_URL = self.DATABASE_URL.replace(
+                "postgresql://", "postgresql+asyncpg://", 1
+            ).replace("sqlite://", "sqlite+aiosqlite://", 1)
+
         self.UNSUBSCRIBE_URL = self.BASE_URL + "/api/webhooks/unsubscribe"
         self.PIXEL_URL = self.BASE_URL + "/api/webhooks/pixel"
 
-        if self.MAIL_ADDRESS.endswith("gmail.com"):
-            self.DAILY_LIMIT = 500-100 # gmail free
-        else:
-            self.DAILY_LIMIT = 2000-100 # workspace
+        if not self.SENDER_ACCOUNTS:
+            if not (self.MAIL_ADDRESS and self.SMTP_HOST and self.SMTP_PORT):
+                raise ValueError("SENDER_ACCOUNTS or MAIL_ADDRESS/SMTP_HOST/SMTP_PORT required")
+            self.SENDER_ACCOUNTS = [
+                SenderAccount(
+                    address=self.MAIL_ADDRESS,
+                    password=self.MAIL_PWD or "",
+                    smtp_host=self.SMTP_HOST,
+                    smtp_port=self.SMTP_PORT,
+                    smtp_ssl=self.SMTP_SSL,
+                    daily_limit=self.DAILY_LIMIT,
+                )
+            ]
+        # the global rate limits apply to the accounts without their own
+        for account in self.SENDER_ACCOUNTS:
+            account.rate_limit_per_minute = (
+                account.rate_limit_per_minute or self.RATE_LIMIT_PER_MINUTE
+            )
+            account.rate_limit_per_second = (
+                account.rate_limit_per_second or self.RATE_LIMIT_PER_SECOND
+            )
 
 
 settings = Settings()
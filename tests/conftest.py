@@ -0,0 +1,18 @@
+import os
+
+
+# the settings required at import, for the tests not to need a .env file
+for name, value in {
+    "ENV_STATE": "test",
+    "MAIL_ADDRESS": "hello@tinymail.test",
+    "MAIL_PWD": "",
+    "SMTP_HOST": "localhost",
+    "SMTP_PORT": "25",
+    "SMTP_SSL": "false",
+    "CONF_TOKEN_SECRET_KEY": "secret",
+    "CONF_TOKEN_PASSWORD_SALT": "salt",
+    "DATABASE_URL": "sqlite://",
+    "REDISCLOUD_URL": "redis://localhost:6379/0",
+    "BASE_URL": "http://localhost",
+}.items():
+    os.environ.setdefault(name, value)
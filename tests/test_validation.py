@@ -0,0 +1,138 @@
+import dns.exception
+import dns.resolver
+import pytest
+
+from app import validation
+from app.validation import DomainCache, EmailValidator
+
+
+class MX(object):
+    def __init__(self, exchange: str, preference: int = 10):
+        self.exchange = exchange
+        self.preference = preference
+
+
+class StubResolver(object):
+    """Answers from a table of (domain, record type) -> records: a domain
+    missing from the table does not exist, a record type missing for a known
+    domain has no answer."""
+
+    def __init__(self, records: dict, timeouts=()):
+        self.records = records
+        self.timeouts = set(timeouts)
+        self.queries = []
+
+    def resolve(self, domain: str, record: str):
+        self.queries.append((domain, record))
+        if domain in self.timeouts:
+            raise dns.exception.Timeout()
+        if not any(name == domain for name, _ in self.records):
+            raise dns.resolver.NXDOMAIN()
+        if (domain, record) not in self.records:
+            raise dns.resolver.NoAnswer()
+        return self.records[(domain, record)]
+
+
+@pytest.fixture
+def resolver():
+    return StubResolver(
+        {
+            ("mx.example", "MX"): [MX("mail.mx.example.")],
+            ("a-only.example", "A"): ["192.0.2.1"],
+            ("aaaa-only.example", "AAAA"): ["2001:db8::1"],
+            ("null-mx.example", "MX"): [MX(".", preference=0)],
+        },
+        timeouts=["slow.example"],
+    )
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(validation.time, "monotonic", lambda: now[0])
+    return now
+
+
+def make_validator(resolver, **kwargs) -> EmailValidator:
+    return EmailValidator(
+        dns_resolver=resolver, cache=DomainCache(**kwargs), max_workers=2
+    )
+
+
+def test_syntax_is_checked_without_dns(resolver):
+    validator = make_validator(resolver)
+
+    emails = ["not-an-email", "a@@mx.example", "a@mx.example"]
+    assert validator.validate_many(emails) == [None, None, "a@mx.example"]
+    assert validator.validate("bad address@mx.example") is None
+    email = validator.validate("a@unknown.example", check_deliverability=False)
+    assert email == "a@unknown.example"
+    assert resolver.queries.count(("mx.example", "MX")) == 1
+    assert not any(domain == "unknown.example" for domain, _ in resolver.queries)
+
+
+def test_mx_and_address_fallbacks(resolver):
+    validator = make_validator(resolver)
+
+    assert validator.validate("a@mx.example") == "a@mx.example"
+    assert validator.validate("a@a-only.example") == "a@a-only.example"
+    assert validator.validate("a@aaaa-only.example") == "a@aaaa-only.example"
+    assert ("a-only.example", "A") in resolver.queries
+    assert ("aaaa-only.example", "AAAA") in resolver.queries
+
+
+def test_undeliverable_domains(resolver):
+    validator = make_validator(resolver)
+
+    assert validator.validate("a@nxdomain.example") is None
+    assert validator.validate("a@null-mx.example") is None
+    error = validator.check_domain("nxdomain.example")
+    assert error == "The domain name nxdomain.example does not exist."
+
+
+def test_timeouts_are_accepted_and_not_cached(resolver):
+    validator = make_validator(resolver)
+
+    assert validator.validate("a@slow.example") == "a@slow.example"
+    assert validator.validate("b@slow.example") == "b@slow.example"
+    assert resolver.queries.count(("slow.example", "MX")) == 2
+
+
+def test_domains_are_resolved_once_per_batch_and_cached(resolver):
+    validator = make_validator(resolver)
+
+    emails = [f"user{i}@mx.example" for i in range(50)] + ["a@nxdomain.example"]
+    assert validator.validate_many(emails) == emails[:50] + [None]
+    emails = ["b@mx.example", "b@nxdomain.example"]
+    assert validator.validate_many(emails) == ["b@mx.example", None]
+
+    assert resolver.queries.count(("mx.example", "MX")) == 1
+    assert resolver.queries.count(("nxdomain.example", "MX")) == 1
+    assert validator.cache.stats["hits"] == 2
+
+
+def test_cache_ttl_expiry(resolver, clock):
+    validator = make_validator(resolver, ttl=60, negative_ttl=10)
+
+    validator.validate_many(["a@mx.example", "a@nxdomain.example"])
+    clock[0] += 30
+    validator.validate_many(["a@mx.example", "a@nxdomain.example"])
+    # the negative entry expired, the positive one did not
+    assert resolver.queries.count(("mx.example", "MX")) == 1
+    assert resolver.queries.count(("nxdomain.example", "MX")) == 2
+
+    clock[0] += 31
+    validator.validate("a@mx.example")
+    assert resolver.queries.count(("mx.example", "MX")) == 2
+
+
+def test_cache_evicts_least_recently_used():
+    cache = DomainCache(maxsize=2)
+    cache.set("a.example")
+    cache.set("b.example", "undeliverable")
+    assert cache.get("a.example") == (True, None)
+    cache.set("c.example")
+
+    assert cache.get("b.example") == (False, None)
+    assert cache.get("a.example") == (True, None)
+    assert cache.stats["evictions"] == 1